@@ -0,0 +1,86 @@
+"""
+Benchmark of Getter.prepared (server-side prepared statements) against plain execution,
+for a getter called repeatedly with different query_attributes().
+
+Usage: python benchmarks/prepared_statements.py [n_calls]
+Connection info is taken from the PG* environment variables (defaults: localhost:5432, user postgres, database test__db_fillers).
+"""
+
+import os
+import sys
+import time
+import statistics
+
+import db_fillers as dbf
+from db_fillers import Database
+
+conninfo = {
+    "host": os.environ.get("PGHOST", "localhost"),
+    "port": int(os.environ.get("PGPORT", 5432)),
+    "database": os.environ.get("PGDATABASE", "test__db_fillers"),
+    "user": os.environ.get("PGUSER", "postgres"),
+}
+
+
+class ColumnsGetter(dbf.Getter):
+    """
+    Query over information_schema views: cheap to execute, expensive to plan
+    """
+
+    columns = ["table_name", "column_name", "data_type"]
+
+    def __init__(self, table_name, **kwargs):
+        dbf.Getter.__init__(self, **kwargs)
+        self.table_name = table_name
+
+    def query(self):
+        return """SELECT c.table_name, c.column_name, c.data_type
+                FROM information_schema.columns c
+                JOIN information_schema.tables t
+                    ON t.table_schema=c.table_schema AND t.table_name=c.table_name
+                WHERE c.table_name=%(table_name)s
+                ORDER BY c.ordinal_position;"""
+
+    def query_attributes(self):
+        return {"table_name": self.table_name}
+
+    def parse_results(self, query_result):
+        return query_result
+
+
+def run(db, n_calls, prepared):
+    tables = ["_fillers_info", "_exec_info", "_fillers_changes", "pg_class"]
+    durations = []
+    for i in range(n_calls):
+        getter = ColumnsGetter(table_name=tables[i % len(tables)], db=db)
+        t0 = time.perf_counter()
+        getter.get_result(prepared=prepared)
+        durations.append(time.perf_counter() - t0)
+    return durations
+
+
+def planning_time(db):
+    db.cursor.execute(
+        "EXPLAIN (ANALYZE, FORMAT JSON) " + ColumnsGetter("_fillers_info").query(),
+        {"table_name": "_fillers_info"},
+    )
+    plan = db.cursor.fetchone()[0][0]
+    return plan["Planning Time"], plan["Execution Time"]
+
+
+if __name__ == "__main__":
+    n_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    db = Database(**conninfo)
+    db.init_db()
+    planning, execution = planning_time(db)
+    print(
+        f"Single query: planning {planning:.3f} ms, execution {execution:.3f} ms (EXPLAIN ANALYZE)"
+    )
+    run(db, 10, prepared=True)  # warm-up, and PREPARE outside of the measure
+    for prepared in (False, True):
+        durations = run(db, n_calls, prepared=prepared)
+        print(
+            f"prepared={prepared}: {n_calls} calls, total {sum(durations):.3f} s, "
+            f"median {statistics.median(durations)*1000:.3f} ms/call"
+        )
+    db.connection.close()
@@ -1,3 +1,6 @@
 from .database import Database
-from .getters import Getter
+from .getters import Getter, GetterGroup
 from .fillers import Filler
+from .throttling import WriteController
+from .memory import MemoryTracker, MemoryLimitExceeded
+from .content_store import ContentStore
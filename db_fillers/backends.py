@@ -0,0 +1,569 @@
+import os
+import io
+import re
+import csv
+import copy
+import uuid
+import decimal
+import sqlite3
+import logging
+import datetime
+import numpy as np
+import psycopg2
+import psycopg2.pool
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger.setLevel(logging.INFO)
+
+
+class Backend(object):
+    """
+    Database engine used by a Database object: connections, pools, init script, and the few engine-specific statements
+    used by Database itself (scripts, tables listing, dropping tables).
+    Connections returned by connect() follow the psycopg2 API (cursor(), commit(), rollback(), close(),
+    cursor.execute with %(name)s/%s parameters, cursor.copy_expert, ...).
+    """
+
+    name = None
+    # file of the init script, in the folder of the module of the Database class
+    init_script = "initscript.sql"
+    # search_path/schema handling (db_schema, additional_searchpath and options of Database)
+    search_path = False
+    # server-side prepared statements (see Database.prepared_statements)
+    prepared_statements = False
+    # base class of the errors raised by the driver for failing statements
+    error_class = psycopg2.Error
+
+    def normalize_conninfo(self, conninfo):
+        return conninfo
+
+    def connect(self, conninfo, fallback_db=None):
+        raise NotImplementedError
+
+    def new_connection(self, conninfo):
+        return self.connect(conninfo)
+
+    def get_pool(self, maxconn, conninfo):
+        raise NotImplementedError
+
+    def execute_script(self, cursor, script):
+        cursor.execute(script)
+
+    def get_tables(self, cursor):
+        raise NotImplementedError
+
+    def drop_table(self, cursor, table):
+        raise NotImplementedError
+
+
+class PostgresBackend(Backend):
+    """
+    Default backend, PostgreSQL through psycopg2
+    """
+
+    name = "postgresql"
+    search_path = True
+    prepared_statements = True
+
+    def connect(self, conninfo, fallback_db="postgres"):
+        """
+        Connects to the database, creating it (by connecting first to fallback_db) if it does not exist
+        """
+        try:
+            return psycopg2.connect(**conninfo)
+        except psycopg2.OperationalError as e:
+            if 'database "{}" does not exist\n'.format(conninfo["database"]) in str(e):
+                pgpass_env = "PGPASSFILE"
+                default_pgpass = os.path.join(os.environ["HOME"], ".pgpass")
+                if pgpass_env not in os.environ.keys():
+                    os.environ[pgpass_env] = default_pgpass
+                conninfo_nodb = copy.deepcopy(conninfo)
+                conninfo_nodb.update(dict(database=fallback_db))
+                logger.warning(
+                    "Database {} does not exist: trying to create it via connecting primarily to database {}".format(
+                        conninfo["database"], conninfo_nodb["database"]
+                    )
+                )
+                conn = psycopg2.connect(**conninfo_nodb)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute(
+                    sql.SQL("CREATE DATABASE {};").format(
+                        sql.Identifier(conninfo["database"])
+                    )
+                )
+                cur.close()
+                conn.close()
+                return psycopg2.connect(**conninfo)
+            else:
+                pgpass_env = "PGPASSFILE"
+                default_pgpass = os.path.join(os.environ["HOME"], ".pgpass")
+                if pgpass_env not in os.environ.keys():
+                    os.environ[pgpass_env] = default_pgpass
+                    logger.info(
+                        "Password authentication failed,trying to set .pgpass env variable"
+                    )
+                    return psycopg2.connect(**conninfo)
+                else:
+                    raise
+
+    def new_connection(self, conninfo):
+        return psycopg2.connect(**conninfo)
+
+    def get_pool(self, maxconn, conninfo):
+        return psycopg2.pool.ThreadedConnectionPool(1, maxconn, **conninfo)
+
+    def get_tables(self, cursor):
+        cursor.execute(
+            """SELECT table_name FROM information_schema.tables
+            where table_schema=CURRENT_SCHEMA AND table_type='BASE TABLE'; """
+        )
+        return [t[0] for t in cursor.fetchall()]
+
+    def drop_table(self, cursor, table):
+        cursor.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+
+
+for np_type in (
+    np.int8,
+    np.int16,
+    np.int32,
+    np.int64,
+    np.uint8,
+    np.uint16,
+    np.uint32,
+    np.uint64,
+):
+    sqlite3.register_adapter(np_type, int)
+for np_type in (np.float16, np.float32, np.float64):
+    sqlite3.register_adapter(np_type, float)
+sqlite3.register_adapter(np.bool_, bool)
+sqlite3.register_adapter(decimal.Decimal, str)
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda d: d.isoformat(" "))
+
+
+def render_composable(query):
+    """
+    SQL string of a psycopg2.sql object, without a psycopg2 connection
+    """
+    if isinstance(query, sql.Composed):
+        return "".join(render_composable(q) for q in query.seq)
+    elif isinstance(query, sql.SQL):
+        return query.string
+    elif isinstance(query, sql.Identifier):
+        return ".".join('"{}"'.format(s.replace('"', '""')) for s in query.strings)
+    elif isinstance(query, sql.Literal):
+        return quote_literal(query.wrapped)
+    elif isinstance(query, sql.Placeholder):
+        return "%s" if query.name is None else f"%({query.name})s"
+    else:
+        raise TypeError(f"Unsupported SQL object: {query!r}")
+
+
+def quote_literal(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None:
+        return "NULL"
+    elif isinstance(value, bool):
+        return "1" if value else "0"
+    elif isinstance(value, float):
+        return "NULL" if value != value else repr(value)
+    elif isinstance(value, (int, decimal.Decimal)):
+        return str(value)
+    elif isinstance(value, bytes):
+        return "X'{}'".format(value.hex())
+    elif isinstance(value, datetime.datetime):
+        return "'{}'".format(value.isoformat(" "))
+    elif isinstance(value, datetime.date):
+        return "'{}'".format(value.isoformat())
+    else:
+        return "'{}'".format(str(value).replace("'", "''"))
+
+
+# psycopg2 parameters: %(name)s, %s, and %% for a literal %
+PARAMETER_PATTERN = re.compile(r"%\((\w+)\)s|%s|%%")
+SHOW_PATTERN = re.compile(r"^\s*SHOW\s+(\w+)\s*;?\s*$", re.I)
+SET_PATTERN = re.compile(r"^\s*SET\s+(\w+)\s*(?:TO|=)\s*(.+?)\s*;?\s*$", re.I | re.S)
+TRUNCATE_PATTERN = re.compile(
+    r"^\s*TRUNCATE\s+(?:TABLE\s+)?(.+?)\s*;?\s*$", re.I | re.S
+)
+COPY_FROM_PATTERN = re.compile(
+    r"^\s*COPY\s+(?P<table>[^\s(]+)\s*(?:\((?P<columns>[^)]*)\))?\s*FROM\s+STDIN\s*(?P<options>.*?)\s*;?\s*$",
+    re.I | re.S,
+)
+COPY_TO_PATTERN = re.compile(
+    r"^\s*COPY\s*\((?P<query>.*)\)\s*TO\s+STDOUT\s*(?P<options>.*?)\s*;?\s*$",
+    re.I | re.S,
+)
+COPY_TEXT_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+def get_copy_options(options):
+    """
+    Options of a COPY statement, in the new (WITH (FORMAT CSV, ...)) or old (CSV HEADER ...) syntax
+    """
+    csv_format = re.search(r"\bCSV\b", options, re.I) is not None
+    delimiter = re.search(r"\bDELIMITER\s+'(.)'", options, re.I)
+    null = re.search(r"\bNULL\s+'([^']*)'", options, re.I)
+    quote = re.search(r"\bQUOTE\s+'(.)'", options, re.I)
+    return dict(
+        csv_format=csv_format,
+        header=re.search(r"\bHEADER\b(?!\s+(FALSE|OFF|0)\b)", options, re.I)
+        is not None,
+        delimiter=(
+            delimiter.group(1)
+            if delimiter is not None
+            else ("," if csv_format else "\t")
+        ),
+        null=null.group(1) if null is not None else ("" if csv_format else "\\N"),
+        quotechar=quote.group(1) if quote is not None else '"',
+    )
+
+
+class SQLiteCursor(object):
+    """
+    psycopg2-like cursor on a SQLite connection: psycopg2 parameters and sql objects, COPY (in text and CSV formats)
+    through copy_expert, TRUNCATE, and SHOW/SET of session settings (kept in the connection).
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.connection.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def translate(self, query, variables):
+        if isinstance(query, sql.Composable):
+            query = render_composable(query)
+        elif isinstance(query, bytes):
+            query = query.decode("utf-8")
+        if variables is None:
+            return query, ()
+        if isinstance(variables, dict):
+            query = PARAMETER_PATTERN.sub(
+                lambda m: "%" if m.group(0) == "%%" else f":{m.group(1)}", query
+            )
+        else:
+            query = PARAMETER_PATTERN.sub(
+                lambda m: "%" if m.group(0) == "%%" else "?", query
+            )
+        return query, variables
+
+    def mogrify(self, query, variables=None):
+        if isinstance(query, sql.Composable):
+            query = render_composable(query)
+        if variables is None:
+            return query.encode("utf-8")
+        if isinstance(variables, dict):
+            ans = PARAMETER_PATTERN.sub(
+                lambda m: (
+                    "%" if m.group(0) == "%%" else quote_literal(variables[m.group(1)])
+                ),
+                query,
+            )
+        else:
+            values = iter(variables)
+            ans = PARAMETER_PATTERN.sub(
+                lambda m: "%" if m.group(0) == "%%" else quote_literal(next(values)),
+                query,
+            )
+        return ans.encode("utf-8")
+
+    def execute(self, query, variables=None):
+        query, variables = self.translate(query, variables)
+        show = SHOW_PATTERN.match(query)
+        if show is not None:
+            self.cursor.execute(
+                "SELECT ?;", (self.connection.settings.get(show.group(1), ""),)
+            )
+            return
+        set_match = SET_PATTERN.match(query)
+        if set_match is not None:
+            value = set_match.group(2)
+            if value in ("?",) or value.startswith(":"):
+                value = (
+                    variables[value[1:]]
+                    if isinstance(variables, dict)
+                    else variables[0]
+                )
+            self.connection.settings[set_match.group(1)] = str(value).strip("'")
+            return
+        truncate = TRUNCATE_PATTERN.match(query)
+        if truncate is not None:
+            query = f"DELETE FROM {truncate.group(1)};"
+        self.cursor.execute(query, variables)
+
+    def executemany(self, query, variables_list):
+        variables_list = list(variables_list)
+        query, _ = self.translate(
+            query, variables_list[0] if len(variables_list) else ()
+        )
+        self.cursor.executemany(query, variables_list)
+
+    def executescript(self, script):
+        self.cursor.executescript(script)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self.cursor.fetchmany()
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+    def copy_expert(self, query, file, size=8192):
+        if isinstance(query, sql.Composable):
+            query = render_composable(query)
+        elif isinstance(query, bytes):
+            query = query.decode("utf-8")
+        copy_from = COPY_FROM_PATTERN.match(query)
+        if copy_from is not None:
+            return self.copy_from_file(
+                file=file,
+                table=copy_from.group("table"),
+                columns=copy_from.group("columns"),
+                **get_copy_options(copy_from.group("options")),
+            )
+        copy_to = COPY_TO_PATTERN.match(query)
+        if copy_to is not None:
+            return self.copy_to_file(
+                file=file,
+                query=copy_to.group("query"),
+                **get_copy_options(copy_to.group("options")),
+            )
+        raise NotImplementedError(
+            f"Only COPY table FROM STDIN and COPY (query) TO STDOUT are supported with SQLite: {query}"
+        )
+
+    def copy_from_file(
+        self, file, table, columns, csv_format, header, delimiter, null, quotechar
+    ):
+        data = file.read()
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        if csv_format:
+            rows = csv.reader(
+                io.StringIO(data), delimiter=delimiter, quotechar=quotechar
+            )
+            if header:
+                next(rows, None)
+            rows = [[None if v == null else v for v in row] for row in rows]
+        else:
+            lines = data.split("\n")
+            if header:
+                lines = lines[1:]
+            rows = []
+            for line in lines:
+                if line == "\\.":
+                    break
+                if line == "":
+                    continue
+                rows.append(
+                    [
+                        (
+                            None
+                            if v == null
+                            else re.sub(
+                                r"\\(.)",
+                                lambda m: COPY_TEXT_ESCAPES.get(m.group(1), m.group(1)),
+                                v,
+                            )
+                        )
+                        for v in line.split(delimiter)
+                    ]
+                )
+        if not len(rows):
+            return
+        columns = "" if columns is None else f"({columns})"
+        self.cursor.executemany(
+            "INSERT INTO {} {} VALUES ({});".format(
+                table, columns, ",".join(["?"] * len(rows[0]))
+            ),
+            rows,
+        )
+
+    def copy_to_file(self, file, query, csv_format, header, delimiter, null, quotechar):
+        self.cursor.execute(query)
+        buffer = io.StringIO()
+        if csv_format:
+            writer = csv.writer(
+                buffer, delimiter=delimiter, quotechar=quotechar, lineterminator="\n"
+            )
+            if header:
+                writer.writerow([d[0] for d in self.cursor.description])
+            for row in self.cursor:
+                writer.writerow([null if v is None else v for v in row])
+        else:
+            if header:
+                buffer.write(
+                    delimiter.join(d[0] for d in self.cursor.description) + "\n"
+                )
+            for row in self.cursor:
+                buffer.write(
+                    delimiter.join(
+                        (
+                            null
+                            if v is None
+                            else str(v)
+                            .replace("\\", "\\\\")
+                            .replace("\t", "\\t")
+                            .replace("\n", "\\n")
+                            .replace("\r", "\\r")
+                        )
+                        for v in row
+                    )
+                    + "\n"
+                )
+        if isinstance(file, io.TextIOBase):
+            file.write(buffer.getvalue())
+        else:
+            file.write(buffer.getvalue().encode("utf-8"))
+
+
+class SQLiteConnection(object):
+    """
+    psycopg2-like connection to a SQLite database, see SQLiteCursor
+    """
+
+    encoding = "UTF8"
+
+    def __init__(self, database, **kwargs):
+        uri = database.startswith("file:")
+        self.connection = sqlite3.connect(
+            database, uri=uri, check_same_thread=False, **kwargs
+        )
+        self.settings = {"DateStyle": "ISO, MDY", "max_prepared_transactions": "0"}
+        self.closed = 0
+
+    def cursor(self, name=None, **kwargs):
+        return SQLiteCursor(connection=self)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        if not self.closed:
+            self.connection.close()
+            self.closed = 1
+
+
+class SQLitePool(object):
+    """
+    Minimal connection pool with the API of psycopg2 pools, SQLite connections being cheap to open
+    """
+
+    def __init__(self, maxconn, conninfo):
+        self.maxconn = maxconn
+        self.conninfo = conninfo
+        self.closed = False
+        self.connections = []
+
+    def getconn(self):
+        connection = SQLiteConnection(**self.conninfo)
+        self.connections.append(connection)
+        return connection
+
+    def putconn(self, connection):
+        connection.close()
+        self.connections.remove(connection)
+
+    def closeall(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.closed = True
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded in-process backend, for fast tests of fillers and getters using portable SQL.
+    The database connection info is just the path of the database file (database=...), or ":memory:"
+    for an in-memory database, shared by the connections of the Database object (e.g. for pools or workers)
+    and dropped when all of them are closed.
+    Not supported: schemas/search_path, server-side prepared statements, two-phase commits, partitioned tables,
+    materialized views, and PostgreSQL-specific syntax in queries (e.g. ::casts, ON COMMIT DROP).
+    """
+
+    name = "sqlite"
+    init_script = "initscript_sqlite.sql"
+    error_class = sqlite3.Error
+
+    def normalize_conninfo(self, conninfo):
+        conninfo = dict(conninfo)
+        if conninfo.get("database", ":memory:") == ":memory:":
+            conninfo[
+                "database"
+            ] = f"file:db_fillers_{uuid.uuid4().hex}?mode=memory&cache=shared"
+        return conninfo
+
+    def connect(self, conninfo, fallback_db=None):
+        return SQLiteConnection(**conninfo)
+
+    def get_pool(self, maxconn, conninfo):
+        return SQLitePool(maxconn=maxconn, conninfo=conninfo)
+
+    def execute_script(self, cursor, script):
+        cursor.executescript(script)
+
+    def get_tables(self, cursor):
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+        )
+        return [t[0] for t in cursor.fetchall()]
+
+    def drop_table(self, cursor, table):
+        cursor.execute(f'DROP TABLE IF EXISTS "{table}";')
+
+
+backends = {
+    "postgresql": PostgresBackend,
+    "postgres": PostgresBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def get_backend(backend):
+    """
+    Backend instance from a Backend or a backend name
+    """
+    if isinstance(backend, Backend):
+        return backend
+    elif backend in backends.keys():
+        return backends[backend]()
+    else:
+        raise ValueError(
+            f"Unknown backend: {backend}, should be a Backend or in {list(backends.keys())}"
+        )
@@ -0,0 +1,158 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger.setLevel(logging.INFO)
+
+# read-only, files linked to a blob share its mode
+BLOB_MODE = 0o444
+
+
+def hash_file(path, block_size=2**20):
+    """
+    SHA256 hex digest of a file, read by blocks
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ContentStore(object):
+    """
+    Content-addressed store of files, keyed by SHA256, backing the files of data folders (see Database content_store option).
+    Files added to the store are replaced by hardlinks to a single blob per content, so that identical files downloaded
+    or extracted by several fillers (or in several data folders) use the disk space once.
+    When hardlinks are not possible (e.g. store on another filesystem), files are copied to the store and left as they are.
+
+    Blobs are shared by all their links: files of the data folder should be replaced (e.g. unlinked before being rewritten),
+    never modified in place. Blobs are made read-only to enforce it (for users other than root).
+    Blobs not referenced by any file anymore (link count of 1) are removed by gc().
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.logger = logger
+        for subfolder in ("blobs", "manifests", "tmp"):
+            os.makedirs(os.path.join(self.folder, subfolder), exist_ok=True)
+
+    def blob_path(self, digest):
+        return os.path.join(self.folder, "blobs", digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def tmp_path(self):
+        return os.path.join(self.folder, "tmp", uuid.uuid4().hex)
+
+    def add(self, path):
+        """
+        Adds a file to the store and replaces it by a hardlink to the blob with the same content. Returns its SHA256.
+        """
+        digest = hash_file(path)
+        blob = self.blob_path(digest)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, path):
+                self.link(digest, path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = self.tmp_path()
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copyfile(path, tmp)
+            os.chmod(tmp, BLOB_MODE)
+            os.replace(tmp, blob)
+        return digest
+
+    def link(self, digest, path):
+        """
+        Makes path a hardlink to the blob of digest (replacing an existing file), or a copy if hardlinks are not possible
+        """
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            raise FileNotFoundError(f"Missing blob in content store: {digest}")
+        if os.path.exists(path) and os.path.samefile(blob, path):
+            # already linked (renaming a link onto another link of the same file would do nothing)
+            return
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        tmp = os.path.join(folder, f".{os.path.basename(path)}.{uuid.uuid4().hex}")
+        try:
+            os.link(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)
+        os.replace(tmp, path)
+
+    def add_folder(self, folder):
+        """
+        Adds all the files of a folder to the store, returns a dict relative path:SHA256
+        """
+        ans = {}
+        for root, dirs, files in os.walk(folder):
+            for f in files:
+                path = os.path.join(root, f)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    ans[os.path.relpath(path, folder)] = self.add(path)
+        return ans
+
+    def manifest_path(self, digest):
+        return os.path.join(self.folder, "manifests", f"{digest}.json")
+
+    def get_manifest(self, digest):
+        """
+        Content of an archive extracted before (dict relative path:SHA256), if all its blobs are still in the store, otherwise None
+        """
+        path = self.manifest_path(digest)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            manifest = json.load(f)
+        if all(self.has(d) for d in manifest.values()):
+            return manifest
+        else:
+            return None
+
+    def set_manifest(self, digest, manifest):
+        tmp = self.tmp_path()
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.manifest_path(digest))
+
+    def gc(self):
+        """
+        Removes blobs not referenced by any file anymore, and manifests referring to removed blobs.
+        Returns the number of blobs removed and the number of bytes freed.
+        """
+        removed = 0
+        freed = 0
+        blobs_folder = os.path.join(self.folder, "blobs")
+        for prefix in os.listdir(blobs_folder):
+            prefix_folder = os.path.join(blobs_folder, prefix)
+            for name in os.listdir(prefix_folder):
+                blob = os.path.join(prefix_folder, name)
+                stat = os.stat(blob)
+                if stat.st_nlink == 1:
+                    os.remove(blob)
+                    removed += 1
+                    freed += stat.st_size
+            if not len(os.listdir(prefix_folder)):
+                os.rmdir(prefix_folder)
+        manifests_folder = os.path.join(self.folder, "manifests")
+        for name in os.listdir(manifests_folder):
+            if self.get_manifest(name[: -len(".json")]) is None:
+                os.remove(os.path.join(manifests_folder, name))
+        self.logger.info(
+            f"Content store gc: removed {removed} blobs, freed {freed/2**20:.1f} MB"
+        )
+        return removed, freed
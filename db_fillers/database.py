@@ -1,13 +1,29 @@
 import psycopg2
+import psycopg2.pool
+import psycopg2.errors
 from psycopg2 import extras, sql
 import os
 import copy
 import logging
 import csv
 import hashlib
+import io
+import time
 import numpy as np
+import pandas as pd
 import inspect
 import uuid
+import re
+import collections
+import threading
+import weakref
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .getters import GetterGroup
+from .memory import MemoryTracker, MemoryLimitExceeded
+from .content_store import ContentStore, hash_file
+from .backends import get_backend
 
 logger = logging.getLogger(__name__)
 ch = logging.StreamHandler()
@@ -22,8 +38,28 @@ try:
     from psycopg2 import extras
     from psycopg2.extensions import register_adapter, AsIs
 
-    register_adapter(np.float64, AsIs)
-    register_adapter(np.int64, AsIs)
+    def adapt_numpy_float(f):
+        if np.isnan(f):
+            return AsIs("NULL")
+        elif np.isinf(f):
+            return AsIs("'Infinity'::FLOAT" if f > 0 else "'-Infinity'::FLOAT")
+        else:
+            return AsIs(repr(float(f)))
+
+    for t in (np.float64, np.float32, np.float16):
+        register_adapter(t, adapt_numpy_float)
+    for t in (
+        np.int64,
+        np.int32,
+        np.int16,
+        np.int8,
+        np.uint64,
+        np.uint32,
+        np.uint16,
+        np.uint8,
+    ):
+        register_adapter(t, AsIs)
+    register_adapter(np.bool_, lambda b: AsIs("TRUE" if b else "FALSE"))
 except ImportError:
     logger.info(
         "Psycopg2 not installed, pip install psycopg2 (or binary-psycopg2) if you want to use a PostgreSQL DB"
@@ -36,6 +72,203 @@ def split_sql_init(script):
     return formatted.split(";")[:-1]
 
 
+def copy_escape(series):
+    """
+    Escapes a Series of strings for the text format of COPY
+    """
+    return (
+        series.str.replace("\\", "\\\\", regex=False)
+        .str.replace("\t", "\\t", regex=False)
+        .str.replace("\n", "\\n", regex=False)
+        .str.replace("\r", "\\r", regex=False)
+    )
+
+
+def serialize_column(series):
+    """
+    Converts a whole column to the text format of COPY at once (no per-row python conversion),
+    with \\N for missing values (None, NaN, NaT, pd.NA).
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        if len(dtype.categories) == 0:
+            return pd.Series("\\N", index=series.index, dtype=object)
+        categories = serialize_column(pd.Series(dtype.categories)).to_numpy()
+        codes = series.cat.codes.to_numpy()
+        return pd.Series(
+            np.where(codes < 0, "\\N", categories[codes]), index=series.index
+        )
+
+    mask = series.isna().to_numpy()
+    if pd.api.types.is_bool_dtype(dtype):
+        values = np.where(series.fillna(False).to_numpy(dtype=bool), "t", "f")
+    elif pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, "tz", None) is not None:
+            values = np.char.add(
+                np.datetime_as_string(
+                    series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy(),
+                    unit="us",
+                ),
+                "+00",
+            )
+        else:
+            values = np.datetime_as_string(series.to_numpy(), unit="us")
+    elif pd.api.types.is_timedelta64_dtype(dtype):
+        values = (series.dt.total_seconds().astype(str) + " seconds").to_numpy()
+    elif pd.api.types.is_numeric_dtype(dtype):
+        values = series.astype(str).to_numpy()
+    else:
+        values = copy_escape(series.astype(str)).to_numpy()
+    return pd.Series(np.where(mask, "\\N", values), index=series.index)
+
+
+def dataframe_to_copy_text(df):
+    """
+    Serializes a DataFrame to the text format of COPY, column by column
+    """
+    if len(df.index) == 0:
+        return ""
+    columns = [serialize_column(df.iloc[:, i]) for i in range(len(df.columns))]
+    lines = columns[0].str.cat(columns[1:], sep="\t")
+    return "\n".join(lines.to_numpy()) + "\n"
+
+
+def copy_text_value(value):
+    """
+    Formats a single python value for the text format of COPY
+    """
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, float) and np.isnan(value):
+        return "\\N"
+    else:
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
+
+def rows_to_copy_text(rows):
+    """
+    Serializes an iterable of rows (tuples or lists) to the text format of COPY
+    """
+    return "".join("\t".join(copy_text_value(v) for v in row) + "\n" for row in rows)
+
+
+def table_identifier(table):
+    """
+    sql.Identifier for a table name, potentially qualified with its schema (schema.table)
+    """
+    return sql.Identifier(*table.split("."))
+
+
+def to_prepared_query(query):
+    """
+    Converts a query using the %(variablename)s (or %s) convention to the $1, $2, ... convention of PREPARE.
+    Returns the converted query and the list of parameter keys (names, or positions for %s), in the order of the $n.
+    """
+    keys = []
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) is None:
+            key = len(keys)
+        else:
+            key = match.group(1)
+            if key in keys:
+                return "${}".format(keys.index(key) + 1)
+        keys.append(key)
+        return "${}".format(len(keys))
+
+    return re.sub(r"%%|%(?:\((\w+)\))?s", replace, query), keys
+
+
+class PreparedStatementCache(object):
+    """
+    Keeps track of server-side prepared statements: a query text is PREPAREd once per connection, and EXECUTEd afterwards.
+    Each connection has its own LRU-bounded set of statements (least recently used ones are DEALLOCATEd),
+    which is discarded when the connection is garbage collected or connected to a new backend.
+    Tuple parameters (e.g. for IN %(values)s) cannot be passed as prepared statement parameters, use = ANY(%(values)s) with lists instead.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.connections = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def get_statements(self, connection):
+        backend_pid = connection.get_backend_pid()
+        with self.lock:
+            entry = self.connections.get(connection)
+            if entry is None or entry[0] != backend_pid:
+                entry = (backend_pid, collections.OrderedDict())
+                self.connections[connection] = entry
+        return entry[1]
+
+    def execute(self, cursor, query, variables=None):
+        statements = self.get_statements(cursor.connection)
+        if query in statements:
+            name, keys = statements[query]
+            statements.move_to_end(query)
+        else:
+            while len(statements) >= self.maxsize:
+                old_name, _ = statements.popitem(last=False)[1]
+                cursor.execute("DEALLOCATE {};".format(old_name))
+            prepared_query, keys = to_prepared_query(query.strip().rstrip(";"))
+            name = "dbf_prepared_{}".format(uuid.uuid4().hex)
+            cursor.execute("PREPARE {} AS {};".format(name, prepared_query))
+            statements[query] = (name, keys)
+
+        if len(keys):
+            if variables is None:
+                raise ValueError(f"Missing variables for prepared query: {query}")
+            execute_query = "EXECUTE {} ({});".format(
+                name, ",".join(["%s"] * len(keys))
+            )
+            execute_variables = [variables[k] for k in keys]
+        else:
+            execute_query = "EXECUTE {};".format(name)
+            execute_variables = None
+        try:
+            cursor.execute(execute_query, execute_variables)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # the statement does not exist anymore (e.g. after a DISCARD ALL), it will be prepared again on next call
+            statements.pop(query, None)
+            raise
+        # other errors (e.g. in the values of the variables) leave the statement valid: PREPARE is not undone by a rollback
+
+    def clear(self, connection=None):
+        """
+        Forgets the statements of a connection (or of all connections), e.g. after a DISCARD ALL.
+        """
+        with self.lock:
+            if connection is None:
+                self.connections.clear()
+            else:
+                self.connections.pop(connection, None)
+
+
+class DatabaseView(object):
+    """
+    A Database seen through another connection (e.g. taken from a pool by a worker thread):
+    connection and cursor are the ones of that connection, other attributes are the ones of the database.
+    """
+
+    def __init__(self, db, connection):
+        self.database = db
+        self.connection = connection
+        self.cursor = connection.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
 class Database(object):
     """
     This class creates a database object with the main structure, with a few methods  to manipulate it.
@@ -44,6 +277,7 @@ class Database(object):
     """
 
     tables_whitelist = ["spatial_ref_sys"]
+    prepared_statements_maxsize = 64
 
     def __init__(
         self,
@@ -55,16 +289,25 @@ class Database(object):
         additional_searchpath=["postgis"],
         DB_INIT=None,
         fallback_db="postgres",
+        memory_tracking=False,
+        memory_soft_limit=None,
+        memory_hard_limit=None,
+        tracemalloc_top=0,
+        content_store=None,
+        backend="postgresql",
         **db_conninfo,
     ):
         self.logger = logger
-        self.db_conninfo = copy.deepcopy(
-            db_conninfo
+        # backend: "postgresql" (default), "sqlite" for an embedded database (e.g. for tests), or a backends.Backend
+        self.backend = get_backend(backend)
+        self.db_conninfo = self.backend.normalize_conninfo(
+            copy.deepcopy(db_conninfo)
         )  # db_conninfo can be partly defined in ~/.pgpass, especially for passwords. See postgres doc for more info.
 
         if DB_INIT is None:
             init_sql_file = os.path.join(
-                os.path.dirname(inspect.getfile(self.__class__)), "initscript.sql"
+                os.path.dirname(inspect.getfile(self.__class__)),
+                self.backend.init_script,
             )
             if not os.path.exists(init_sql_file):
                 raise IOError(f"Missing file: {init_sql_file}")
@@ -73,8 +316,14 @@ class Database(object):
         else:
             self.DB_INIT = DB_INIT
 
+        if not self.backend.search_path and db_schema is not None:
+            raise ValueError(
+                f"Schemas are not supported by backend {self.backend.name}"
+            )
         # Schemas order : [db_schema if not None] + [options if provided or orig_searchpath(default or DB specific) ]+ additional_searchpath
-        if db_schema is not None or additional_searchpath is not None:
+        if self.backend.search_path and (
+            db_schema is not None or additional_searchpath is not None
+        ):
             if db_schema is None:
                 # db_schema = 'public'
                 searchpath = []
@@ -117,6 +366,7 @@ class Database(object):
                         data_folder=data_folder,
                         db_schema=None,
                         additional_searchpath=None,
+                        backend=self.backend,
                     )
                 )
                 try:
@@ -133,6 +383,7 @@ class Database(object):
                             data_folder=data_folder,
                             db_schema=None,
                             additional_searchpath=None,
+                            backend=self.backend,
                             database=fallback_db,
                         )
                     )
@@ -177,47 +428,14 @@ class Database(object):
             logger.warning(
                 "You are providing your password directly, this could be a security concern, consider using solutions like .pgpass file."
             )
-        try:
-            self.connection = psycopg2.connect(**self.db_conninfo)
-        except psycopg2.OperationalError as e:
-            if 'database "{}" does not exist\n'.format(db_conninfo["database"]) in str(
-                e
-            ):
-                pgpass_env = "PGPASSFILE"
-                default_pgpass = os.path.join(os.environ["HOME"], ".pgpass")
-                if pgpass_env not in os.environ.keys():
-                    os.environ[pgpass_env] = default_pgpass
-                conninfo_nodb = copy.deepcopy(self.db_conninfo)
-                conninfo_nodb.update(dict(database=fallback_db))
-                # conninfo_nodb.update(dict(database=fallback_db,additional_searchpath=None,db_schema=None))
-                self.logger.warning(
-                    "Database {} does not exist: trying to create it via connecting primarily to database {}".format(
-                        db_conninfo["database"], conninfo_nodb["database"]
-                    )
-                )
-                conn = psycopg2.connect(**conninfo_nodb)
-                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                cur = conn.cursor()
-                cur.execute(
-                    psycopg2.sql.SQL("CREATE DATABASE {};").format(
-                        psycopg2.sql.Identifier(self.db_conninfo["database"])
-                    )
-                )
-                cur.close()
-                conn.close()
-                self.connection = psycopg2.connect(**self.db_conninfo)
-            else:
-                pgpass_env = "PGPASSFILE"
-                default_pgpass = os.path.join(os.environ["HOME"], ".pgpass")
-                if pgpass_env not in os.environ.keys():
-                    os.environ[pgpass_env] = default_pgpass
-                    self.logger.info(
-                        "Password authentication failed,trying to set .pgpass env variable"
-                    )
-                    self.connection = psycopg2.connect(**self.db_conninfo)
-                else:
-                    raise
+        self.connection = self.backend.connect(
+            self.db_conninfo, fallback_db=fallback_db
+        )
         self.cursor = self.connection.cursor()
+        self.pool = None
+        self.prepared_statements = PreparedStatementCache(
+            maxsize=self.prepared_statements_maxsize
+        )
         if db_schema is not None:
             self.cursor.execute("SELECT schema_name FROM information_schema.schemata;")
             schemas = [s[0] for s in self.cursor.fetchall() if s is not None]
@@ -229,11 +447,22 @@ class Database(object):
                 self.connection.commit()
 
         self.register_exec = register_exec
+        self.memory_tracking = memory_tracking
+        self.memory_soft_limit = memory_soft_limit
+        self.memory_hard_limit = memory_hard_limit
+        self.tracemalloc_top = tracemalloc_top
 
         self.fillers = []
         self.data_folder = data_folder
         if not os.path.exists(self.data_folder):
             os.makedirs(self.data_folder)
+        # content_store: None (disabled), True (store in the data folder) or path of a store, see content_store.ContentStore
+        if content_store is True:
+            content_store = os.path.join(self.data_folder, "_content_store")
+        if content_store is None or content_store is False:
+            self.content_store = None
+        else:
+            self.content_store = ContentStore(folder=content_store)
         self.pre_initscript = pre_initscript
         self.post_initscript = post_initscript
 
@@ -247,23 +476,19 @@ class Database(object):
 
         for t in tables:
             self.check_sqlname_safe(t)
-            self.cursor.execute(f"DROP TABLE IF EXISTS {t} CASCADE;")
+            self.backend.drop_table(self.cursor, t)
         if commit:
             self.connection.commit()
 
     def get_tables(self):
-        self.cursor.execute(
-            """SELECT table_name FROM information_schema.tables
-            where table_schema=CURRENT_SCHEMA AND table_type='BASE TABLE'; """
-        )
-        return [t[0] for t in self.cursor.fetchall()]
+        return self.backend.get_tables(self.cursor)
 
     def init_db(self):
         # for cmd in split_sql_init(self.DB_INIT)+split_sql_init(self.pre_initscript)+split_sql_init(self.post_initscript):
         for cmd in (self.pre_initscript, self.DB_INIT, self.post_initscript):
             if cmd != "" and cmd is not None:
                 self.logger.debug(cmd)
-                self.cursor.execute(cmd)
+                self.backend.execute_script(self.cursor, cmd)
         if self.register_exec:
             self.register_exec_content()
         self.connection.commit()
@@ -279,7 +504,8 @@ class Database(object):
                     filler_args=f.get_relevant_attr_string(),
                     status="init_prepare",
                 )
-                f.prepare()
+                with self.track_memory(filler=f, step="prepare"):
+                    f.prepare()
                 self.logger.info("Prepared filler {}".format(f.name))
                 self.register_filler_content(
                     filler_class=f.__class__.__name__,
@@ -298,9 +524,10 @@ class Database(object):
                             filler_args=f.get_relevant_attr_string(),
                             status="init_apply",
                         )
-                        f.apply()
-                        f.done = True
-                        f.post_apply()
+                        with self.track_memory(filler=f, step="apply"):
+                            f.apply()
+                            f.done = True
+                            f.post_apply()
                         self.register_filler_content(
                             filler_class=f.__class__.__name__,
                             filler_args=f.get_relevant_attr_string(),
@@ -311,6 +538,169 @@ class Database(object):
             filler_class="fill_db", filler_args=None, status="end_fill_db"
         )
 
+    def fill_dbs(self, targets, workers=None, raise_errors=False):
+        """
+        Fills several databases with the same fillers (e.g. staging, replicas, shards), running the prepare step of each filler
+        once on this database, and its apply step concurrently on all targets, each with its own connection.
+        Each target gets its own _fillers_info bookkeeping. A target for which an apply step fails is rolled back
+        and skipped for the next fillers, while the other targets go on.
+        Memory is tracked once per filler around the whole fan-out (RSS and tracemalloc are process-wide), and registered
+        on this database; when memory_hard_limit is exceeded, fill_dbs is aborted once the running apply steps end.
+        Returns a dict target:error, with None for the targets filled successfully.
+        """
+        targets = list(targets)
+        if workers is None:
+            workers = len(targets)
+        errors = {t: None for t in targets}
+        self.register_filler_content(
+            filler_class="fill_dbs", filler_args=None, status="start_fill_dbs"
+        )
+        for t in targets:
+            t.register_filler_content(
+                filler_class="fill_db", filler_args=None, status="start_fill_db"
+            )
+
+        def apply(target, f):
+            target_filler = f.copy_for_db(target)
+            target.register_filler_content(
+                filler_class=f.__class__.__name__,
+                filler_args=f.get_relevant_attr_string(),
+                status="init_apply",
+            )
+            try:
+                target_filler.apply()
+                target_filler.done = True
+                target_filler.post_apply()
+            except Exception:
+                target.connection.rollback()
+                target.register_filler_content(
+                    filler_class=f.__class__.__name__,
+                    filler_args=f.get_relevant_attr_string(),
+                    status="failed_apply",
+                )
+                raise
+            target.register_filler_content(
+                filler_class=f.__class__.__name__,
+                filler_args=f.get_relevant_attr_string(),
+                status="end_apply",
+            )
+
+        for f in self.fillers:
+            if f.done:
+                continue
+            self.register_filler_content(
+                filler_class=f.__class__.__name__,
+                filler_args=f.get_relevant_attr_string(),
+                status="init_prepare",
+            )
+            with self.track_memory(filler=f, step="prepare"):
+                f.prepare()
+            self.logger.info("Prepared filler {}".format(f.name))
+            self.register_filler_content(
+                filler_class=f.__class__.__name__,
+                filler_args=f.get_relevant_attr_string(),
+                status="end_prepare",
+            )
+            if f.done:
+                continue
+            if not f.check_requirements():
+                raise Exception(f"Requirements not fulfilled for filler: {f.name}")
+            remaining = [t for t in targets if errors[t] is None]
+            with self.track_memory(filler=f, step="apply"):
+                with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                    futures = {t: executor.submit(apply, t, f) for t in remaining}
+            for t, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(
+                        f"Failed applying filler {f.name} on database {t.db_conninfo.get('database')}: {e.__class__.__name__}: {e}"
+                    )
+                    errors[t] = e
+            f.done = True
+            self.logger.info(
+                "Filled {}/{} databases with filler {}".format(
+                    len(remaining)
+                    - len([t for t in remaining if errors[t] is not None]),
+                    len(targets),
+                    f.name,
+                )
+            )
+
+        for t in targets:
+            if errors[t] is None:
+                t.register_filler_content(
+                    filler_class="fill_db", filler_args=None, status="end_fill_db"
+                )
+        self.register_filler_content(
+            filler_class="fill_dbs", filler_args=None, status="end_fill_dbs"
+        )
+        failed = [t for t in targets if errors[t] is not None]
+        if raise_errors and len(failed):
+            raise Exception(
+                f"Errors when filling databases:{[(t.db_conninfo.get('database'),errors[t].__class__,str(errors[t])) for t in failed]}"
+            )
+        return errors
+
+    @contextlib.contextmanager
+    def track_memory(self, filler, step):
+        """
+        Tracks the memory used by a step of a filler (see memory.MemoryTracker) if memory_tracking is set or limits are provided,
+        and registers it in _fillers_memory if memory_tracking is set.
+        When memory_hard_limit (bytes of RSS) is exceeded, the step is aborted: the transaction is rolled back,
+        and the abort is registered in _fillers_info before raising MemoryLimitExceeded.
+        """
+        if (
+            not self.memory_tracking
+            and self.memory_soft_limit is None
+            and self.memory_hard_limit is None
+        ):
+            yield None
+            return
+        tracker = MemoryTracker(
+            soft_limit=self.memory_soft_limit,
+            hard_limit=self.memory_hard_limit,
+            tracemalloc_top=self.tracemalloc_top if self.memory_tracking else 0,
+            label=f"filler {filler.name} ({step})",
+        )
+        try:
+            with tracker:
+                yield tracker
+        except MemoryLimitExceeded:
+            self.connection.rollback()
+            self.register_filler_content(
+                filler_class=filler.__class__.__name__,
+                filler_args=filler.get_relevant_attr_string(),
+                status=f"memory_limit_exceeded_{step}",
+            )
+            if self.memory_tracking:
+                self.register_filler_memory(filler=filler, step=step, tracker=tracker)
+            raise MemoryLimitExceeded(tracker.get_abort_message())
+        if self.memory_tracking:
+            self.register_filler_memory(filler=filler, step=step, tracker=tracker)
+            self.logger.info(
+                f"Memory of filler {filler.name} ({step}): peak RSS delta {tracker.rss_peak_delta/2**20:.1f} MB"
+            )
+
+    def register_filler_memory(self, filler, step, tracker):
+        self.cursor.execute(
+            """
+                INSERT INTO _fillers_memory(class,args,step,rss_start,rss_peak,rss_peak_delta,duration,top_allocations)
+                VALUES (%s,%s,%s,%s,%s,%s,%s,%s);
+                """,
+            (
+                filler.__class__.__name__,
+                filler.get_relevant_attr_string(),
+                step,
+                tracker.rss_start,
+                tracker.rss_peak,
+                tracker.rss_peak_delta,
+                tracker.duration,
+                "\n".join(tracker.top_allocations),
+            ),
+        )
+        self.connection.commit()
+
     def add_filler(self, f):
         if f.name in [ff.name for ff in self.fillers if ff.unique_name]:
             self.logger.warning("Filler {} already present".format(f.name))
@@ -321,6 +711,43 @@ class Database(object):
             f.after_insert()
             self.logger.info("Added filler {}".format(f.name))
 
+    def new_connection(self):
+        """
+        Opens an additional connection with the same connection info (and search path), e.g. for concurrent workers.
+        """
+        return self.backend.new_connection(self.db_conninfo)
+
+    def get_pool(self, maxconn):
+        """
+        Returns a thread-safe connection pool sharing the connection info of the database.
+        The pool is kept between calls and only recreated if more connections are needed.
+        """
+        if self.pool is None or self.pool.closed or self.pool.maxconn < maxconn:
+            self.close_pool()
+            self.pool = self.backend.get_pool(
+                maxconn=maxconn, conninfo=self.db_conninfo
+            )
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None and not self.pool.closed:
+            self.pool.closeall()
+        self.pool = None
+
+    def get_view(self, connection):
+        """
+        Returns a view of the database using another connection, see DatabaseView
+        """
+        return DatabaseView(db=self, connection=connection)
+
+    def get_many(self, getters, workers=4, **kwargs):
+        """
+        Runs several getters concurrently on pooled connections, returns a dict of results keyed by getter name.
+        """
+        return GetterGroup(getters=getters, db=self).get_results(
+            workers=workers, **kwargs
+        )
+
     def check_empty(self, table):
         self.cursor.execute("SELECT * FROM {table} LIMIT 1;".format(table=table))
         ans = self.cursor.fetchone()
@@ -346,8 +773,10 @@ class Database(object):
         self.connection.commit()
         if folder is None:
             folder = self.data_folder
-        with open(os.path.join(folder, filename), "rb") as f:
-            filehash = hashlib.sha256(f.read()).hexdigest()
+        if self.content_store is not None:
+            filehash = self.content_store.add(os.path.join(folder, filename))
+        else:
+            filehash = hash_file(os.path.join(folder, filename))
         self.cursor.execute(
             "INSERT INTO file_hash(filecode,filename,filehash) VALUES(%s,%s,%s) ON CONFLICT (filecode) DO UPDATE SET filecode=EXCLUDED.filecode,filename=EXCLUDED.filename,filehash=EXCLUDED.filehash;",
             (filecode, filename, filehash),
@@ -389,6 +818,141 @@ class Database(object):
         )
         self.connection.commit()
 
+    def copy_from_buffer(self, buffer, table, columns=None, cursor=None):
+        """
+        COPY a file-like object in the text format of COPY into a table
+        """
+        if cursor is None:
+            cursor = self.cursor
+        if columns is None:
+            query = sql.SQL("COPY {} FROM STDIN;").format(table_identifier(table))
+        else:
+            query = sql.SQL("COPY {} ({}) FROM STDIN;").format(
+                table_identifier(table),
+                sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+            )
+        cursor.copy_expert(query, buffer)
+
+    def write_dataframe(
+        self,
+        df,
+        table,
+        mode="append",
+        conflict_columns=None,
+        chunksize=100000,
+        cursor=None,
+        commit=True,
+        controller=None,
+    ):
+        """
+        Writes a DataFrame into an existing table through COPY, serializing whole columns at once (see serialize_column).
+        Columns of the DataFrame are matched by name with the columns of the table.
+        mode can be:
+         - append: COPY into the table
+         - replace: TRUNCATE the table then COPY into it, in the same transaction
+         - upsert: COPY into a temp staging table, then INSERT ... ON CONFLICT (conflict_columns) DO UPDATE
+        With a controller (see throttling.WriteController), chunks are sized and throttled by the controller,
+        and committed every controller.commit_every chunks in append mode.
+        """
+        if mode not in ("append", "replace", "upsert"):
+            raise ValueError(
+                f"Unknown mode for write_dataframe: {mode}, should be append, replace or upsert"
+            )
+        if mode == "upsert" and not conflict_columns:
+            raise ValueError("conflict_columns have to be provided for mode upsert")
+        if cursor is None:
+            cursor = self.cursor
+        columns = [str(c) for c in df.columns]
+
+        if mode == "replace":
+            cursor.execute(
+                sql.SQL("TRUNCATE TABLE {};").format(table_identifier(table))
+            )
+        if mode == "upsert":
+            target = table
+            table = f"_dbf_staging_{uuid.uuid4().hex}"
+            cursor.execute(
+                sql.SQL(
+                    "CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} LIMIT 0;"
+                ).format(
+                    sql.Identifier(table),
+                    sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+                    table_identifier(target),
+                )
+            )
+
+        start = 0
+        while start < len(df.index):
+            if controller is not None:
+                chunksize = controller.batch_size
+            text = dataframe_to_copy_text(df.iloc[start : start + chunksize])
+            t0 = time.time()
+            self.copy_from_buffer(
+                buffer=io.StringIO(text), table=table, columns=columns, cursor=cursor
+            )
+            if controller is not None:
+                controller.record(
+                    rows=len(df.index[start : start + chunksize]),
+                    seconds=time.time() - t0,
+                    nbytes=len(text),
+                )
+                if controller.should_commit() and mode == "append":
+                    cursor.connection.commit()
+            start += chunksize
+
+        if mode == "upsert":
+            update_columns = [c for c in columns if c not in conflict_columns]
+            if len(update_columns):
+                on_conflict = sql.SQL("DO UPDATE SET {}").format(
+                    sql.SQL(",").join(
+                        [
+                            sql.SQL("{c}=EXCLUDED.{c}").format(c=sql.Identifier(c))
+                            for c in update_columns
+                        ]
+                    )
+                )
+            else:
+                on_conflict = sql.SQL("DO NOTHING")
+            cursor.execute(
+                sql.SQL(
+                    "INSERT INTO {target} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT ({conflict}) {on_conflict};"
+                ).format(
+                    target=table_identifier(target),
+                    columns=sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+                    staging=sql.Identifier(table),
+                    conflict=sql.SQL(",").join(
+                        [sql.Identifier(c) for c in conflict_columns]
+                    ),
+                    on_conflict=on_conflict,
+                )
+            )
+            cursor.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier(table)))
+        if commit:
+            cursor.connection.commit()
+
+    def register_filler_changes(
+        self,
+        filler_class,
+        filler_args,
+        table,
+        inserted,
+        updated,
+        deleted,
+        cursor=None,
+        commit=True,
+    ):
+        if cursor is None:
+            cursor = self.cursor
+        cursor.execute(
+            """
+                INSERT INTO _fillers_changes(class,args,table_name,inserted,updated,deleted)
+                VALUES (%s,%s,%s,%s,%s,%s);
+                """,
+            (filler_class, filler_args, table, inserted, updated, deleted),
+        )
+        if commit:
+            cursor.connection.commit()
+
     def execute_named_cursor(self, query, variables=None, prefix="", batch=False):
         cursor_name = f"{prefix}_{uuid.uuid1()}"
         with self.connection.cursor(name=cursor_name) as cur:
@@ -4,7 +4,7 @@ import zipfile
 import pandas as pd
 import logging
 import csv
-from psycopg2 import extras
+from psycopg2 import extras, sql
 import shapefile
 import json
 import subprocess
@@ -12,6 +12,18 @@ import shutil
 import pygit2
 import gzip
 import re
+import uuid
+import hashlib
+import threading
+import io
+import copy
+import contextlib
+import time
+import datetime
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import table_identifier, rows_to_copy_text
 
 logger = logging.getLogger("fillers")
 ch = logging.StreamHandler()
@@ -22,6 +34,114 @@ logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
 
+def record_boundaries(path, targets, quotechar='"', block_size=2**24):
+    """
+    For each target byte offset (sorted), returns the offset of the start of the first record starting at or after it,
+    i.e. after the first newline that is not inside a quoted field (None if there is none before the end of the file).
+    Quotes are counted from the beginning of the file, which is read sequentially up to the last target;
+    with quotechar=None (no quoted newlines in the file), targets are reached directly by seeking.
+    Escaping quotes by doubling them is supported, escaping them with a backslash is not.
+    """
+    boundaries = []
+    quote = None if quotechar is None else quotechar.encode("utf-8")
+    with open(path, "rb") as f:
+        if quote is None:
+            for target in targets:
+                if target == 0:
+                    boundaries.append(0)
+                    continue
+                f.seek(target - 1)
+                f.readline()
+                boundaries.append(f.tell())
+            pending = []
+        else:
+            offset = 0
+            parity = 0
+            pending = list(targets)
+            while len(pending):
+                block = f.read(block_size)
+                if not len(block):
+                    break
+                while len(pending) and pending[0] <= offset + len(block):
+                    if pending[0] == 0:
+                        boundaries.append(0)
+                        pending.pop(0)
+                        continue
+                    pos = max(pending[0] - 1 - offset, 0)
+                    p = (parity + block.count(quote, 0, pos)) % 2
+                    found = None
+                    while True:
+                        nl = block.find(b"\n", pos)
+                        if nl == -1:
+                            break
+                        p = (p + block.count(quote, pos, nl)) % 2
+                        if p == 0:
+                            found = offset + nl + 1
+                            break
+                        pos = nl + 1
+                    if found is None:
+                        # record continues in next block
+                        break
+                    while len(pending) and pending[0] <= found:
+                        boundaries.append(found)
+                        pending.pop(0)
+                parity = (parity + block.count(quote)) % 2
+                offset += len(block)
+    size = os.path.getsize(path)
+    boundaries = [None if b is not None and b >= size else b for b in boundaries]
+    return boundaries + [None] * len(pending)
+
+
+def split_records(path, n_chunks, header=False, quotechar='"', block_size=2**24):
+    """
+    Splits a delimited file in (at most) n_chunks byte ranges (start, end) of similar sizes, cut at record boundaries
+    (quoted newlines included, see record_boundaries). The header, if any, is excluded from the ranges.
+    """
+    size = os.path.getsize(path)
+    start = 0
+    if header:
+        start = record_boundaries(
+            path, [1], quotechar=quotechar, block_size=block_size
+        )[0]
+        if start is None:
+            return []
+    targets = [start + (size - start) * i // n_chunks for i in range(1, n_chunks)]
+    cuts = [
+        b
+        for b in record_boundaries(
+            path, targets, quotechar=quotechar, block_size=block_size
+        )
+        if b is not None
+    ]
+    bounds = sorted(set([start] + cuts + [size]))
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+class FileRange(io.RawIOBase):
+    """
+    Read-only file-like object over a byte range of a file, e.g. to COPY a chunk of a file
+    """
+
+    def __init__(self, path, start, end):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+        io.RawIOBase.close(self)
+
+
 class Filler(object):
     """
     The Filler class and its children provide methods to fill the database, potentially from different sources.
@@ -32,6 +152,9 @@ class Filler(object):
     This class is just an abstract 'mother' class
     """
 
+    _mirror_locks = {}
+    _mirror_locks_lock = threading.Lock()
+
     def __init__(
         self,
         db=None,
@@ -44,6 +167,7 @@ class Filler(object):
         if name is None:
             name = self.__class__.__name__
         self.name = name
+        self.partitioned_tables = {}
         if db is not None:
             db.add_filler(self)
         self.data_folder = data_folder
@@ -92,11 +216,27 @@ class Filler(object):
     def after_insert(self):
         pass
 
+    def get_content_store(self):
+        """
+        Content store of the database (see Database content_store option), None if disabled or if the filler has no database
+        """
+        return getattr(getattr(self, "db", None), "content_store", None)
+
+    def unlink_destination(self, destination):
+        """
+        Removes a file about to be rewritten if a content store is enabled: it may be a link to a blob of the store,
+        that should not be modified in place. To be called by all methods writing files in the data folder.
+        """
+        if self.get_content_store() is not None and os.path.lexists(destination):
+            os.remove(destination)
+
     def download(self, url, destination=None, wget=False, autogzip=False):
         self.logger.info("Downloading {}".format(url))
         if destination is None:
             destination = url.split("/")[-1]
         destination = os.path.join(self.data_folder, destination)
+        store = self.get_content_store()
+        self.unlink_destination(destination)
         if not wget:
             r = requests.get(url, allow_redirects=True)
             r.raise_for_status()
@@ -119,13 +259,448 @@ class Filler(object):
                 subprocess.check_call(
                     "curl -o {} -L {}".format(destination, url).split(" ")
                 )
+        if store is not None:
+            store.add(destination)
+
+    @contextlib.contextmanager
+    def open_stream(self, source, compression="infer", member=None):
+        """
+        Opens a source as a stream of text (decoded with self.encoding), without loading it in memory.
+        source is either a URL (http or https) or a file path relative to the data folder.
+        compression can be None, gzip or zip (infer: from the extension of the source); for zip archives,
+        member is the file to read (default: the only file of the archive).
+        Zip archives have to be downloaded first, as they cannot be streamed.
+        """
+        if compression == "infer":
+            if source.endswith(".gz"):
+                compression = "gzip"
+            elif source.endswith(".zip"):
+                compression = "zip"
+            else:
+                compression = None
+        if compression not in (None, "gzip", "zip"):
+            raise ValueError(f"Unknown compression: {compression}")
+        with contextlib.ExitStack() as stack:
+            if source.startswith("http://") or source.startswith("https://"):
+                if compression == "zip":
+                    raise ValueError(
+                        f"Zip archives cannot be streamed, download {source} first"
+                    )
+                r = stack.enter_context(
+                    requests.get(source, stream=True, allow_redirects=True)
+                )
+                r.raise_for_status()
+                r.raw.decode_content = True
+                binary = r.raw
+            elif compression == "zip":
+                zip_ref = stack.enter_context(
+                    zipfile.ZipFile(os.path.join(self.data_folder, source), "r")
+                )
+                if member is None:
+                    members = [m for m in zip_ref.namelist() if not m.endswith("/")]
+                    if len(members) != 1:
+                        raise ValueError(
+                            f"member has to be provided for archives with several files: {source}"
+                        )
+                    member = members[0]
+                binary = stack.enter_context(zip_ref.open(member, "r"))
+            else:
+                binary = stack.enter_context(
+                    open(os.path.join(self.data_folder, source), "rb")
+                )
+            if compression == "gzip":
+                binary = stack.enter_context(gzip.GzipFile(fileobj=binary, mode="rb"))
+            yield stack.enter_context(
+                io.TextIOWrapper(binary, encoding=self.encoding, newline="")
+            )
+
+    def stream_rows(self, source, header=True, **kwargs):
+        """
+        Generator of the rows of a delimited file (see open_stream for source and kwargs), parsed with self.delimiter.
+        The header row is skipped if header is True.
+        """
+        with self.open_stream(source, **kwargs) as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            if header:
+                next(reader, None)
+            for row in reader:
+                yield row
+
+    def stream_csv(
+        self,
+        source,
+        table,
+        columns=None,
+        transforms=None,
+        header=True,
+        sink=None,
+        batch_size=10000,
+        reject_file=None,
+        max_rejects=None,
+        commit=True,
+        controller=None,
+        **kwargs,
+    ):
+        """
+        Streaming pipeline loading a delimited file into a table with constant memory:
+        source (file, gzip, zip or URL, see open_stream) -> parsing (see stream_rows) -> transforms -> sink, by batches of batch_size rows.
+
+        transforms are functions applied in order to each row, returning the transformed row, or None to filter it out.
+        A transform raising an exception (e.g. for validation) rejects the row.
+        sink is a function writing a batch (list of rows) in the DB, by default a COPY into table (columns); it may return
+        the number of bytes written, used by the controller for max_bytes_per_sec.
+        When a batch fails to be written, it is retried row by row and the failing rows are rejected.
+        Rejected rows are written with the error message in reject_file (in the data folder, default: <table>_rejects.csv)
+        instead of aborting the load, unless more than max_rejects rows are rejected.
+        Values are loaded as parsed, empty fields as empty strings: use transforms to convert them, e.g. to None.
+        With a controller (see throttling.WriteController), the batch size and write rate are set by the controller,
+        and the load is committed every controller.commit_every batches.
+        Returns the counts of loaded, filtered and rejected rows.
+        """
+        if transforms is None:
+            transforms = []
+        if sink is None:
+            sink = self.copy_sink(table=table, columns=columns)
+        if reject_file is None:
+            reject_file = f"{table}_rejects.csv"
+        if os.path.exists(os.path.join(self.data_folder, reject_file)):
+            os.remove(os.path.join(self.data_folder, reject_file))
+        cursor = self.db.cursor
+        error_class = self.db.backend.error_class
+        counts = dict(loaded=0, filtered=0, rejected=0)
+
+        with contextlib.ExitStack() as stack:
+            rejects = []
+
+            def reject(row, error):
+                if not len(rejects):
+                    f = stack.enter_context(
+                        open(
+                            os.path.join(self.data_folder, reject_file),
+                            "w",
+                            encoding=self.encoding,
+                            newline="",
+                        )
+                    )
+                    rejects.append(csv.writer(f, delimiter=self.delimiter))
+                rejects[0].writerow(
+                    list(row) + [f"{error.__class__.__name__}: {error}".strip()]
+                )
+                counts["rejected"] += 1
+                if max_rejects is not None and counts["rejected"] > max_rejects:
+                    raise Exception(
+                        f"Too many rejected rows when loading {source} into {table}: {counts['rejected']}, see {reject_file}"
+                    )
+
+            def write(batch):
+                t0 = time.time()
+                nbytes = 0
+                cursor.execute("SAVEPOINT dbf_stream_batch;")
+                try:
+                    nbytes += sink(batch) or 0
+                except error_class:
+                    cursor.execute("ROLLBACK TO SAVEPOINT dbf_stream_batch;")
+                    for row in batch:
+                        cursor.execute("SAVEPOINT dbf_stream_row;")
+                        try:
+                            nbytes += sink([row]) or 0
+                        except error_class as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT dbf_stream_row;")
+                            reject(row, e)
+                        else:
+                            counts["loaded"] += 1
+                        cursor.execute("RELEASE SAVEPOINT dbf_stream_row;")
+                else:
+                    counts["loaded"] += len(batch)
+                cursor.execute("RELEASE SAVEPOINT dbf_stream_batch;")
+                if controller is not None:
+                    controller.record(
+                        rows=len(batch), seconds=time.time() - t0, nbytes=nbytes
+                    )
+                    if controller.should_commit():
+                        self.db.connection.commit()
+
+            batch = []
+            for row in self.stream_rows(source, header=header, **kwargs):
+                orig_row = row
+                try:
+                    for transform in transforms:
+                        row = transform(row)
+                        if row is None:
+                            break
+                    if row is not None and columns is not None:
+                        if len(row) != len(columns):
+                            raise ValueError(
+                                f"Expected {len(columns)} values, got {len(row)}"
+                            )
+                except Exception as e:
+                    reject(orig_row, e)
+                    continue
+                if row is None:
+                    counts["filtered"] += 1
+                    continue
+                batch.append(row)
+                if controller is not None:
+                    batch_size = controller.batch_size
+                if len(batch) >= batch_size:
+                    write(batch)
+                    batch = []
+            if len(batch):
+                write(batch)
+
+        self.logger.info(
+            f"Streamed {source} into {table}: {counts['loaded']} loaded, {counts['filtered']} filtered, {counts['rejected']} rejected"
+        )
+        if commit:
+            self.db.connection.commit()
+        return counts
+
+    def copy_sink(self, table, columns=None):
+        """
+        Sink for stream_csv: COPY of a batch of rows into table, returning the size of the COPY data
+        """
+
+        def sink(rows):
+            text = rows_to_copy_text(rows)
+            self.db.copy_from_buffer(
+                buffer=io.StringIO(text),
+                table=table,
+                columns=columns,
+            )
+            return len(text)
+
+        return sink
+
+    def parallel_copy(
+        self,
+        filename,
+        table,
+        columns=None,
+        workers=4,
+        header=False,
+        quotechar='"',
+        null="",
+        atomic="tpc",
+        block_size=2**24,
+    ):
+        """
+        Loads a large delimited file into a table with workers concurrent COPY, each on its own connection.
+        The file is split at record boundaries (see split_records; quotechar=None if no field contains newlines, avoiding a full scan of the file).
+        Loading is atomic, all chunks or none are committed, independently from the transaction of the main connection of the DB:
+         - atomic='tpc' uses two-phase commit (requires max_prepared_transactions >= workers on the server)
+         - atomic='staging' COPYs the chunks into an unlogged staging table, then moves its content into the table in one transaction
+        With 'tpc', the method falls back on 'staging' when prepared transactions are not available.
+        Once all chunks are prepared, the load is completed: chunks failing to commit are committed again on a new connection
+        (see finish_prepared_copy), and if this fails too, the error lists the gids of the transactions left prepared,
+        to be finished by hand with COMMIT PREPARED '<gid>' (they hold their locks on the table until then).
+        Rows are routed by PostgreSQL if the table is partitioned.
+        Returns per-chunk statistics (bytes, rows, seconds, MB/s).
+        """
+        if atomic not in ("tpc", "staging"):
+            raise ValueError(f"Unknown atomic mode: {atomic}, should be tpc or staging")
+        path = os.path.join(self.data_folder, filename)
+        chunks = split_records(
+            path,
+            n_chunks=workers,
+            header=header,
+            quotechar=quotechar,
+            block_size=block_size,
+        )
+        if atomic == "tpc":
+            self.db.cursor.execute("SHOW max_prepared_transactions;")
+            max_prepared = int(self.db.cursor.fetchone()[0])
+            if max_prepared < len(chunks):
+                self.logger.warning(
+                    f"max_prepared_transactions ({max_prepared}) lower than number of chunks ({len(chunks)}), falling back on staging table"
+                )
+                atomic = "staging"
+
+        if columns is None:
+            columns_sql = sql.SQL("")
+        else:
+            columns_sql = sql.SQL("({})").format(
+                sql.SQL(",").join([sql.Identifier(c) for c in columns])
+            )
+        if atomic == "staging":
+            # staging table managed on its own connection, leaving the transaction of the main connection untouched
+            control = self.db.new_connection()
+            target = table
+            table = f"_dbf_parallel_copy_{uuid.uuid4().hex}"
+            control.cursor().execute(
+                sql.SQL(
+                    "CREATE UNLOGGED TABLE {} AS SELECT {} FROM {} LIMIT 0;"
+                ).format(
+                    sql.Identifier(table),
+                    sql.SQL("*")
+                    if columns is None
+                    else sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+                    table_identifier(target),
+                )
+            )
+            control.commit()
+        copy_query = sql.SQL(
+            "COPY {} {} FROM STDIN WITH (FORMAT CSV, DELIMITER {}, NULL {}, ENCODING {}{});"
+        ).format(
+            table_identifier(table),
+            columns_sql,
+            sql.Literal(self.delimiter),
+            sql.Literal(null),
+            sql.Literal(self.encoding),
+            sql.SQL("")
+            if quotechar is None
+            else sql.SQL(", QUOTE {}").format(sql.Literal(quotechar)),
+        )
+        gtrid = f"dbf_parallel_copy_{uuid.uuid4().hex}"
+        committing = False
+
+        def copy_chunk(i, start, end):
+            connection = self.db.new_connection()
+            connections[i] = connection
+            if atomic == "tpc":
+                connection.tpc_begin(connection.xid(0, f"{gtrid}_{i}", "db_fillers"))
+            t0 = time.time()
+            reader = FileRange(path, start, end)
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(copy_query, reader)
+                    rows = cursor.rowcount
+            finally:
+                reader.close()
+            if atomic == "tpc":
+                connection.tpc_prepare()
+            else:
+                connection.commit()
+            duration = time.time() - t0
+            stats = dict(
+                chunk=i,
+                bytes=end - start,
+                rows=rows,
+                seconds=duration,
+                mb_per_s=(end - start) / 1e6 / duration if duration > 0 else None,
+            )
+            self.logger.info(
+                f"Copied chunk {i} of {filename}: {rows} rows, {(end-start)/1e6:.1f} MB in {duration:.1f}s"
+            )
+            return stats
+
+        connections = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(chunks), 1)) as executor:
+                futures = [
+                    executor.submit(copy_chunk, i, start, end)
+                    for i, (start, end) in enumerate(chunks)
+                ]
+            errors = []
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    errors.append(e)
+            if len(errors):
+                if atomic == "tpc":
+                    for connection in connections.values():
+                        try:
+                            connection.tpc_rollback()
+                        except psycopg2.Error as e:
+                            self.logger.error(f"Failed rolling back chunk: {e}")
+                raise Exception(
+                    f"Errors in parallel COPY of {filename}:{[(e.__class__,str(e)) for e in errors]}"
+                )
+            if atomic == "tpc":
+                # all chunks are prepared: chunks failing to commit here are committed again by finish_prepared_copy
+                committing = True
+                for i, connection in connections.items():
+                    try:
+                        connection.tpc_commit()
+                    except psycopg2.Error as e:
+                        self.logger.warning(f"Failed committing chunk {i}: {e}")
+            else:
+                control.cursor().execute(
+                    sql.SQL(
+                        "INSERT INTO {target} {columns} SELECT * FROM {staging};"
+                    ).format(
+                        target=table_identifier(target),
+                        columns=columns_sql,
+                        staging=sql.Identifier(table),
+                    )
+                )
+                control.commit()
+        finally:
+            for connection in connections.values():
+                connection.close()
+            if atomic == "tpc":
+                self.finish_prepared_copy(gtrid=gtrid, commit=committing)
+            if atomic == "staging":
+                control.rollback()
+                control.cursor().execute(
+                    sql.SQL("DROP TABLE IF EXISTS {};").format(sql.Identifier(table))
+                )
+                control.commit()
+                control.close()
+        return results
+
+    def finish_prepared_copy(self, gtrid, commit):
+        """
+        Commits (commit=True) or rolls back the transactions of the chunks of a parallel_copy (gtrid dbf_parallel_copy_<uuid>)
+        that are still prepared, e.g. after a connection failure, on a new connection.
+        Raises an error listing the gids (see pg_prepared_xacts) of the transactions that could not be finished.
+        """
+        connection = self.db.new_connection()
+        failed = []
+        try:
+            for xid in connection.tpc_recover():
+                if xid.gtrid is None or not xid.gtrid.startswith(f"{gtrid}_"):
+                    continue
+                try:
+                    if commit:
+                        connection.tpc_commit(xid)
+                    else:
+                        connection.tpc_rollback(xid)
+                except psycopg2.Error as e:
+                    self.logger.error(
+                        f"Failed finishing prepared transaction {xid.gtrid} (gid {xid}): {e}"
+                    )
+                    failed.append(str(xid))
+                else:
+                    self.logger.info(
+                        f"{'Committed' if commit else 'Rolled back'} prepared transaction {xid.gtrid}"
+                    )
+        finally:
+            connection.close()
+        if len(failed):
+            raise Exception(
+                f"Prepared transactions left, to finish with {'COMMIT' if commit else 'ROLLBACK'} PREPARED: {failed}"
+            )
 
     def unzip(self, orig_file, destination, clean_zip=False):
         orig_file = os.path.join(self.data_folder, orig_file)
         destination = os.path.join(self.data_folder, destination)
-        self.logger.info("Unzipping {}".format(orig_file))
-        with zipfile.ZipFile(orig_file, "r") as zip_ref:
-            zip_ref.extractall(destination)
+        store = self.get_content_store()
+        if store is None:
+            self.logger.info("Unzipping {}".format(orig_file))
+            with zipfile.ZipFile(orig_file, "r") as zip_ref:
+                zip_ref.extractall(destination)
+        else:
+            # identical archives are extracted once, their content is then linked from the store
+            digest = store.add(orig_file)
+            manifest = store.get_manifest(digest)
+            if manifest is None:
+                self.logger.info("Unzipping {}".format(orig_file))
+                tmp = store.tmp_path()
+                try:
+                    with zipfile.ZipFile(orig_file, "r") as zip_ref:
+                        zip_ref.extractall(tmp)
+                    manifest = store.add_folder(tmp)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                store.set_manifest(digest, manifest)
+            else:
+                self.logger.info(
+                    "Linking content of {} from content store".format(orig_file)
+                )
+            for path, file_digest in manifest.items():
+                store.link(file_digest, os.path.join(destination, path))
         if clean_zip:
             os.remove(orig_file)
 
@@ -154,6 +729,7 @@ class Filler(object):
         if engine is None:
             engine = self.get_spreadsheet_engine(orig_file=orig_file)
         data = pd.read_excel(orig_file, index_col=None, engine=engine, header=None)
+        self.unlink_destination(destination)
         data.to_csv(destination, index=False, header=None, encoding="utf-8")
         if clean_orig:
             os.remove(orig_file)
@@ -193,8 +769,10 @@ class Filler(object):
                 out_name = clean_sheet_names[name]
             else:
                 out_name = name
+            out_file = os.path.join(destination, "{}.csv".format(out_name))
+            self.unlink_destination(out_file)
             data[name].to_csv(
-                os.path.join(destination, "{}.csv".format(out_name)),
+                out_file,
                 index=False,
                 encoding="utf-8",
                 header=None,
@@ -214,6 +792,414 @@ class Filler(object):
             orig_file, index_col=None, engine=engine, sheet_name=sheet_names
         )
 
+    def load_spreadsheet_sheets(self, orig_file, tables, engine=None, **kwargs):
+        """
+        Loads sheets of a spreadsheet directly into tables (see Database.write_dataframe), without intermediate CSV files.
+        tables is a dict sheet_name:table_name, columns are matched by name with the header row of each sheet.
+        """
+        data = self.extract_spreadsheet_sheets(
+            orig_file=orig_file, sheet_names=list(tables.keys()), engine=engine
+        )
+        for sheet_name, table in tables.items():
+            self.write_dataframe(df=data[sheet_name], table=table, **kwargs)
+
+    def write_dataframe(self, df, table, **kwargs):
+        """
+        Wrapper to write a DataFrame in the DB (see Database.write_dataframe)
+        """
+        self.db.write_dataframe(df=df, table=table, **kwargs)
+
+    def execute_batch(self, query, rows, page_size=100, controller=None, commit=False):
+        """
+        Wrapper of psycopg2.extras.execute_batch on the cursor of the DB.
+        With a controller (see throttling.WriteController), rows are written by batches sized and throttled by the controller,
+        committed every controller.commit_every batches.
+        """
+        if controller is None:
+            extras.execute_batch(self.db.cursor, query, rows, page_size=page_size)
+        else:
+            for batch in controller.batches(rows):
+                t0 = time.time()
+                extras.execute_batch(self.db.cursor, query, batch, page_size=len(batch))
+                controller.record(rows=len(batch), seconds=time.time() - t0)
+                if controller.should_commit():
+                    self.db.connection.commit()
+        if commit:
+            self.db.connection.commit()
+
+    def merge_snapshot(self, df, table, key_columns, delete_missing=True, commit=True):
+        """
+        Incremental merge of a full snapshot (DataFrame) of a table, e.g. for slowly changing reference data.
+        The snapshot is COPYed into a temp staging table, rows are compared with the target on the server side
+        through hashes of the non-key columns, and only the differences are applied with set-based statements:
+        DELETE of rows missing from the snapshot (if delete_missing), UPDATE of changed rows, INSERT of new rows.
+        Change counts are registered in _fillers_changes and returned.
+        """
+        columns = [str(c) for c in df.columns]
+        for k in key_columns:
+            if k not in columns:
+                raise ValueError(f"Key column {k} missing from snapshot of {table}")
+        value_columns = [c for c in columns if c not in key_columns]
+        cursor = self.db.cursor
+        staging = f"_dbf_snapshot_{uuid.uuid4().hex}"
+        cursor.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} LIMIT 0;"
+            ).format(
+                sql.Identifier(staging),
+                sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+                table_identifier(table),
+            )
+        )
+        self.db.write_dataframe(df=df, table=staging, commit=False)
+        cursor.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(staging)))
+
+        def qualified(alias, cols):
+            return sql.SQL(",").join(
+                [
+                    sql.SQL("{}.{}").format(sql.SQL(alias), sql.Identifier(c))
+                    for c in cols
+                ]
+            )
+
+        format_args = dict(
+            target=table_identifier(table),
+            staging=sql.Identifier(staging),
+            columns=sql.SQL(",").join([sql.Identifier(c) for c in columns]),
+            s_columns=qualified("s", columns),
+            keys_match=sql.SQL(" AND ").join(
+                [
+                    sql.SQL("s.{k}=t.{k}").format(k=sql.Identifier(k))
+                    for k in key_columns
+                ]
+            ),
+        )
+
+        deleted = 0
+        if delete_missing:
+            cursor.execute(
+                sql.SQL(
+                    "DELETE FROM {target} t WHERE NOT EXISTS (SELECT 1 FROM {staging} s WHERE {keys_match});"
+                ).format(**format_args)
+            )
+            deleted = cursor.rowcount
+
+        updated = 0
+        if len(value_columns):
+            cursor.execute(
+                sql.SQL(
+                    """UPDATE {target} t SET {set_values} FROM {staging} s
+                        WHERE {keys_match} AND MD5(ROW({t_values})::TEXT) <> MD5(ROW({s_values})::TEXT);"""
+                ).format(
+                    set_values=sql.SQL(",").join(
+                        [
+                            sql.SQL("{c}=s.{c}").format(c=sql.Identifier(c))
+                            for c in value_columns
+                        ]
+                    ),
+                    t_values=qualified("t", value_columns),
+                    s_values=qualified("s", value_columns),
+                    **format_args,
+                )
+            )
+            updated = cursor.rowcount
+
+        cursor.execute(
+            sql.SQL(
+                """INSERT INTO {target} ({columns}) SELECT {s_columns} FROM {staging} s
+                    WHERE NOT EXISTS (SELECT 1 FROM {target} t WHERE {keys_match});"""
+            ).format(**format_args)
+        )
+        inserted = cursor.rowcount
+        cursor.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier(staging)))
+
+        self.logger.info(
+            f"Merged snapshot into {table}: {inserted} inserted, {updated} updated, {deleted} deleted"
+        )
+        self.db.register_filler_changes(
+            filler_class=self.__class__.__name__,
+            filler_args=self.get_relevant_attr_string(),
+            table=table,
+            inserted=inserted,
+            updated=updated,
+            deleted=deleted,
+            commit=commit,
+        )
+        return dict(inserted=inserted, updated=updated, deleted=deleted)
+
+    def declare_partitioned_table(
+        self,
+        table,
+        columns_definition,
+        partition_by,
+        partition_key,
+        interval=None,
+        modulus=None,
+        default_partition=False,
+    ):
+        """
+        Creates (if not existing) a table partitioned on the column partition_key, and registers its partitioning scheme,
+        used to create missing partitions for incoming data and to load partitions independently (see load_partitions).
+        columns_definition is the SQL definition of the columns, e.g. 'id BIGINT, day DATE, value DOUBLE PRECISION'.
+        partition_by can be:
+         - range: interval is day, week, month or year for date/timestamp keys, or a number for numeric keys
+         - list: one partition per value of the key
+         - hash: modulus partitions, all created with the table
+        """
+        if partition_by not in ("range", "list", "hash"):
+            raise ValueError(
+                f"Unknown partitioning: {partition_by}, should be range, list or hash"
+            )
+        if partition_by == "range" and interval is None:
+            raise ValueError("interval has to be provided for range partitioning")
+        if partition_by == "hash" and modulus is None:
+            raise ValueError("modulus has to be provided for hash partitioning")
+        self.partitioned_tables[table] = dict(
+            partition_by=partition_by,
+            partition_key=partition_key,
+            interval=interval,
+            modulus=modulus,
+        )
+        self.db.cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} ({}) PARTITION BY {} ({});").format(
+                table_identifier(table),
+                sql.SQL(columns_definition),
+                sql.SQL(partition_by.upper()),
+                sql.Identifier(partition_key),
+            )
+        )
+        if default_partition:
+            self.db.cursor.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;"
+                ).format(table_identifier(f"{table}_default"), table_identifier(table))
+            )
+        if partition_by == "hash":
+            for remainder in range(modulus):
+                self.create_partition(table=table, value=remainder)
+        self.db.connection.commit()
+
+    def get_partition(self, table, value):
+        """
+        Returns the name and the bounds (SQL) of the partition of table receiving value
+        (for hash partitioning, value is the remainder of the partition)
+        """
+        info = self.partitioned_tables[table]
+        base_table = table.split(".")[-1]
+        if info["partition_by"] == "hash":
+            name = f"{base_table}_h{value}"
+            bounds = sql.SQL("FOR VALUES WITH (MODULUS {}, REMAINDER {})").format(
+                sql.Literal(info["modulus"]), sql.Literal(value)
+            )
+        elif info["partition_by"] == "list":
+            suffix = re.sub("[^a-zA-Z0-9_]", "_", str(value))
+            if suffix != str(value):
+                suffix += "_" + hashlib.md5(str(value).encode("utf-8")).hexdigest()[:8]
+            name = f"{base_table}_{suffix}"
+            bounds = sql.SQL("FOR VALUES IN ({})").format(sql.Literal(value))
+        else:
+            interval = info["interval"]
+            if isinstance(interval, str):
+                if isinstance(value, datetime.datetime):
+                    value = value.date()
+                if interval == "day":
+                    start = value
+                    end = start + datetime.timedelta(days=1)
+                elif interval == "week":
+                    start = value - datetime.timedelta(days=value.weekday())
+                    end = start + datetime.timedelta(days=7)
+                elif interval == "month":
+                    start = datetime.date(value.year, value.month, 1)
+                    end = datetime.date(
+                        value.year + value.month // 12, value.month % 12 + 1, 1
+                    )
+                elif interval == "year":
+                    start = datetime.date(value.year, 1, 1)
+                    end = datetime.date(value.year + 1, 1, 1)
+                else:
+                    raise ValueError(
+                        f"Unknown interval: {interval}, should be day, week, month, year or a number"
+                    )
+                name = f"{base_table}_{start:%Y%m%d}"
+            else:
+                start = (value // interval) * interval
+                end = start + interval
+                name = f"{base_table}_{start}".replace("-", "m").replace(".", "_")
+            bounds = sql.SQL("FOR VALUES FROM ({}) TO ({})").format(
+                sql.Literal(start), sql.Literal(end)
+            )
+        return name, bounds
+
+    def create_partition(self, table, value, cursor=None):
+        """
+        Creates (if not existing) the partition of table receiving value, returns its name
+        """
+        if cursor is None:
+            cursor = self.db.cursor
+        name, bounds = self.get_partition(table=table, value=value)
+        if "." in table:
+            name = table.split(".")[0] + "." + name
+        cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} {};").format(
+                table_identifier(name), table_identifier(table), bounds
+            )
+        )
+        return name
+
+    def split_partitions(self, table, df):
+        """
+        Splits a DataFrame by partition of table, returns a dict partition_name:(value,DataFrame)
+        """
+        info = self.partitioned_tables[table]
+        if info["partition_by"] == "hash":
+            raise ValueError(
+                "Data for hash partitioned tables cannot be split by partition, write it in the parent table"
+            )
+        key = df[info["partition_key"]]
+        names = {v: self.get_partition(table=table, value=v)[0] for v in key.unique()}
+        ans = {}
+        for name, sub_df in df.groupby(key.map(names), sort=False):
+            ans[name] = (sub_df[info["partition_key"]].iloc[0], sub_df)
+        return ans
+
+    def load_partitions(self, table, df, mode="replace", workers=1):
+        """
+        Loads a DataFrame into a partitioned table, partition by partition, creating missing partitions first.
+        Each partition is loaded (and committed) independently, concurrently when workers>1, each worker on its own connection.
+        mode, for each partition receiving data:
+         - append: rows are added to the partition
+         - replace: the partition is truncated, then reloaded in the same transaction
+         - swap: data is loaded in a new table, which replaces the old partition (detached and dropped) in a short transaction;
+           swaps take an exclusive lock on the partitioned table, concurrent workers run them one at a time
+        Returns the names of the loaded partitions.
+        """
+        if mode not in ("append", "replace", "swap"):
+            raise ValueError(f"Unknown mode: {mode}, should be append, replace or swap")
+        partitions = self.split_partitions(table=table, df=df)
+        for value, _ in partitions.values():
+            self.create_partition(table=table, value=value)
+        self.db.connection.commit()
+        swap_lock = threading.Lock()
+
+        def load(name, value, sub_df, connection):
+            with connection.cursor() as cursor:
+                self.load_partition(
+                    table=table,
+                    value=value,
+                    df=sub_df,
+                    mode=mode,
+                    cursor=cursor,
+                    swap_lock=swap_lock,
+                )
+            self.logger.info(f"Loaded partition {name}: {len(sub_df)} rows")
+
+        if workers <= 1:
+            for name, (value, sub_df) in partitions.items():
+                load(name, value, sub_df, self.db.connection)
+        else:
+
+            def load_new_connection(name, value, sub_df):
+                connection = self.db.new_connection()
+                try:
+                    load(name, value, sub_df, connection)
+                finally:
+                    connection.close()
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(load_new_connection, name, value, sub_df)
+                    for name, (value, sub_df) in partitions.items()
+                ]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(e)
+            if len(errors):
+                raise Exception(
+                    f"Errors when loading partitions of {table}:{[(e.__class__,str(e)) for e in errors]}"
+                )
+        return list(partitions.keys())
+
+    def load_partition(
+        self, table, value, df, mode="replace", cursor=None, swap_lock=None
+    ):
+        """
+        Loads a DataFrame into the (existing) partition of table receiving value and commits, see load_partitions for modes.
+        In swap mode, the new table is created and loaded in transactions of its own (so that no lock is kept on the partitioned
+        table while loading), then swapped with the partition under swap_lock if provided (a lock shared by concurrent workers).
+        """
+        if cursor is None:
+            cursor = self.db.cursor
+        name, bounds = self.get_partition(table=table, value=value)
+        if "." in table:
+            name = table.split(".")[0] + "." + name
+        if mode == "swap":
+            new_name = name + "_swap"
+            cursor.execute(
+                sql.SQL(
+                    "DROP TABLE IF EXISTS {new}; CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);"
+                ).format(new=table_identifier(new_name), table=table_identifier(table))
+            )
+            cursor.connection.commit()
+            self.db.write_dataframe(df=df, table=new_name, cursor=cursor, commit=True)
+            if swap_lock is None:
+                swap_lock = contextlib.nullcontext()
+            with swap_lock:
+                self.swap_partition(
+                    table=table,
+                    name=name,
+                    new_name=new_name,
+                    bounds=bounds,
+                    cursor=cursor,
+                )
+        else:
+            self.db.write_dataframe(
+                df=df,
+                table=name,
+                mode="replace" if mode == "replace" else "append",
+                cursor=cursor,
+            )
+
+    def swap_partition(self, table, name, new_name, bounds, cursor):
+        """
+        Replaces partition name of table by table new_name in one transaction
+        """
+        cursor.execute(
+            sql.SQL(
+                """ALTER TABLE {table} DETACH PARTITION {name};
+                        DROP TABLE {name};
+                        ALTER TABLE {new} RENAME TO {base_name};
+                        ALTER TABLE {table} ATTACH PARTITION {name} {bounds};"""
+            ).format(
+                table=table_identifier(table),
+                name=table_identifier(name),
+                new=table_identifier(new_name),
+                base_name=sql.Identifier(name.split(".")[-1]),
+                bounds=bounds,
+            )
+        )
+        cursor.connection.commit()
+
+    def detach_partition(self, table, value, drop=False):
+        """
+        Detaches the partition of table receiving value, and drops it if drop is True
+        """
+        name, _ = self.get_partition(table=table, value=value)
+        if "." in table:
+            name = table.split(".")[0] + "." + name
+        self.db.cursor.execute(
+            sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(
+                table_identifier(table), table_identifier(name)
+            )
+        )
+        if drop:
+            self.db.cursor.execute(
+                sql.SQL("DROP TABLE {};").format(table_identifier(name))
+            )
+        self.db.connection.commit()
+
     def record_file(self, filename, filecode, **kwargs):
         """
         Wrapper to solve data_folder mismatch with DB
@@ -223,40 +1209,168 @@ class Filler(object):
         )
 
     def clone_repo(
-        self, repo_url, update=False, replace=False, repo_folder=None, **kwargs
+        self,
+        repo_url,
+        update=False,
+        replace=False,
+        repo_folder=None,
+        depth=None,
+        branch=None,
+        single_branch=False,
+        mirror_cache=False,
+        mirror_folder=None,
+        **kwargs,
     ):
         """
         Clones a repo locally.
-        If update is True, will execute git pull. Beware, this can fail, and silently. Safe way to update is with replace, but more costly
+        If update is True, will execute git pull, raising an error with the git output if it fails. Safe way to update is with replace, but more costly.
+        depth limits the fetched history (shallow clone), branch selects the branch to check out, and single_branch fetches only this branch.
+        With mirror_cache, a bare mirror of the repo is kept under mirror_folder (default: _mirrors in the data folder of the DB),
+        and working copies are cloned from it sharing its objects (git clone --shared): recloning costs neither network nor disk.
+        The mirror is fetched only when the working copy is cloned, updated or replaced.
+        depth does not apply to mirror clones, which share all objects anyway.
         """
+        if single_branch and branch is None:
+            raise ValueError("branch has to be provided for single_branch clones")
         if repo_folder is None:
             repo_folder = repo_url.split("/")[-1]
             if repo_folder.endswith(".git"):
                 repo_folder = repo_folder[:-4]
         repo_folder = os.path.join(self.data_folder, repo_folder)
+        if mirror_cache and (replace or update or not os.path.exists(repo_folder)):
+            # the mirror is only fetched when the working copy is (re)cloned or updated
+            mirror = self.update_mirror(repo_url=repo_url, mirror_folder=mirror_folder)
         if os.path.exists(repo_folder):
             if replace:
                 self.logger.info(f"Removing folder {repo_folder}")
                 shutil.rmtree(repo_folder)
             elif update:
                 self.logger.info(f"Updating repo in {repo_folder}")
-                cmd2 = "git pull --force --all"
-                cmd_output2 = subprocess.check_output(
-                    cmd2.split(" "),
-                    cwd=repo_folder,
-                    env=os.environ.update(dict(GIT_TERMINAL_PROMPT="0")),
-                )
+                self.run_git(["pull", "--force", "--all"], cwd=repo_folder)
             else:
                 self.logger.info(f"Folder {repo_folder} exists, skipping cloning")
         elif not os.path.exists(os.path.dirname(repo_folder)):
             os.makedirs(os.path.dirname(repo_folder))
         if not os.path.exists(repo_folder):
             self.logger.info(f"Cloning {repo_url} into {repo_folder}")
-            pygit2.clone_repository(url=repo_url, path=repo_folder)
+            if mirror_cache:
+                cmd = ["clone", "--shared"]
+                if branch is not None:
+                    cmd += ["--branch", branch]
+                if single_branch:
+                    cmd.append("--single-branch")
+                self.run_git(cmd + [mirror, repo_folder])
+            else:
+                clone_kwargs = dict(url=repo_url, path=repo_folder)
+                if depth is not None:
+                    clone_kwargs["depth"] = depth
+                if branch is not None:
+                    clone_kwargs["checkout_branch"] = branch
+                if single_branch:
+
+                    def create_remote(repo, name, url):
+                        if isinstance(name, bytes):
+                            name = name.decode("utf-8")
+                        return repo.remotes.create(
+                            name,
+                            url,
+                            f"+refs/heads/{branch}:refs/remotes/{name}/{branch}",
+                        )
+
+                    clone_kwargs["remote"] = create_remote
+                pygit2.clone_repository(**clone_kwargs)
+
+    def update_mirror(self, repo_url, mirror_folder=None):
+        """
+        Creates or fetches the bare mirror of a repo in the mirror cache, returns its path.
+        Mirrors never prune objects, as working copies cloned with --shared may still use them.
+        """
+        if mirror_folder is None:
+            db = getattr(self, "db", None)
+            data_folder = self.data_folder if db is None else db.data_folder
+            mirror_folder = os.path.join(data_folder, "_mirrors")
+        mirror_name = repo_url.rstrip("/").split("/")[-1]
+        if mirror_name.endswith(".git"):
+            mirror_name = mirror_name[:-4]
+        url_hash = hashlib.sha1(repo_url.encode("utf-8")).hexdigest()[:12]
+        mirror = os.path.join(mirror_folder, f"{mirror_name}-{url_hash}.git")
+
+        with self._mirror_locks_lock:
+            lock = self._mirror_locks.setdefault(
+                os.path.abspath(mirror), threading.Lock()
+            )
+        with lock:
+            if os.path.exists(mirror):
+                self.logger.info(f"Fetching mirror of {repo_url} in {mirror}")
+                self.run_git(["remote", "update"], cwd=mirror)
+            else:
+                self.logger.info(f"Creating mirror of {repo_url} in {mirror}")
+                if not os.path.exists(mirror_folder):
+                    os.makedirs(mirror_folder, exist_ok=True)
+                self.run_git(["clone", "--mirror", repo_url, mirror])
+                self.run_git(["config", "gc.pruneExpire", "never"], cwd=mirror)
+        return mirror
+
+    def clone_repos(self, repo_urls, workers=4, raise_errors=False, **kwargs):
+        """
+        Clones several repos with a bounded pool of workers (see clone_repo for kwargs).
+        Returns a dict repo_url:error, with None for the repos cloned successfully.
+        """
+        errors = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                repo_url: executor.submit(self.clone_repo, repo_url=repo_url, **kwargs)
+                for repo_url in repo_urls
+            }
+            for repo_url, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(
+                        f"Failed cloning {repo_url}: {e.__class__.__name__}: {e}"
+                    )
+                    errors[repo_url] = e
+                else:
+                    errors[repo_url] = None
+        failed = [k for k, v in errors.items() if v is not None]
+        self.logger.info(f"Cloned {len(errors)-len(failed)}/{len(errors)} repos")
+        if raise_errors and len(failed):
+            raise Exception(
+                f"Errors when cloning repos:{[(k,errors[k].__class__,str(errors[k])) for k in failed]}"
+            )
+        return errors
+
+    def run_git(self, args, cwd=None):
+        """
+        Runs a git command without terminal prompts, raising an error with the git output if it fails
+        """
+        result = subprocess.run(
+            ["git"] + args,
+            cwd=cwd,
+            env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"git {' '.join(args)} failed with exit code {result.returncode}: {result.stderr.strip()}"
+            )
+        return result.stdout
 
     def post_apply(self):
         pass
 
+    def copy_for_db(self, db):
+        """
+        Shallow copy of the filler, with prepared state (files, data_folder, ...) shared, applying to another database
+        (see Database.fill_dbs).
+        """
+        ans = copy.copy(self)
+        ans.db = db
+        ans.done = False
+        ans.partitioned_tables = dict(self.partitioned_tables)
+        return ans
+
     def check_sql_safe(self, n, allow_chars=None):
         if allow_chars is not None:
             for c in allow_chars:
@@ -370,6 +1484,13 @@ class CoalesceFiller(Filler):
         if hasattr(self, "selected_filler"):
             self.selected_filler.post_apply()
 
+    def copy_for_db(self, db):
+        ans = Filler.copy_for_db(self, db)
+        ans.fillers = [f.copy_for_db(db) for f in self.fillers]
+        if hasattr(self, "selected_filler"):
+            ans.selected_filler = ans.fillers[self.fillers.index(self.selected_filler)]
+        return ans
+
     def get_relevant_attr_string(self):
         ans = f"""'fillers':{[(f.__class__.__name__,f.get_relevant_attr_string()) for f in self.fillers]}"""
         if hasattr(self, "selected_filler"):
@@ -378,3 +1499,323 @@ class CoalesceFiller(Filler):
                 + ans
             )
         return ans
+
+
+class DerivedTableFiller(Filler):
+    """
+    A filler building a table (or a materialized view) derived from source tables by an SQL query, e.g. aggregates.
+    It is refreshed only if its sources changed since its last end_apply in _fillers_info, or if its query changed;
+    changes are detected transactionally, as soon as committed, without scanning the sources:
+    statement-level triggers installed on the sources (and their partitions) by refresh log their INSERT, UPDATE, DELETE and TRUNCATE
+    statements in _derived_sources_changes, and the storage of the sources is checked in pg_class.
+    Sources should be tables, or materialized views refreshed by a DerivedTableFiller (which logs its refreshes),
+    as triggers cannot be set on materialized views.
+
+    Materialized views with a unique index (e.g. created from unique_columns) are refreshed CONCURRENTLY, without blocking reads.
+    Derived tables are truncated and refilled in one transaction, keeping objects depending on them.
+    See DerivedTablesFiller to refresh independent derived tables in parallel.
+    """
+
+    def __init__(
+        self,
+        table,
+        query,
+        sources,
+        materialized_view=True,
+        unique_columns=None,
+        force=False,
+        **kwargs,
+    ):
+        kwargs.setdefault("name", f"{self.__class__.__name__}_{table}")
+        Filler.__init__(self, **kwargs)
+        self.table = table
+        self.query = query.strip().rstrip(";")
+        self.sources = list(sources)
+        self.materialized_view = materialized_view
+        self.unique_columns = unique_columns
+        self.force = force
+        self.relevant_attributes = ["table", "sources", "materialized_view"]
+
+    def apply(self):
+        self.refresh(connection=self.db.connection)
+
+    def get_query_hash(self):
+        return hashlib.sha256(self.query.encode("utf-8")).hexdigest()
+
+    def get_sources_tree(self, cursor):
+        """
+        List of (oid, name, relfilenode, relkind) of the sources and of their partitions (or inheriting tables)
+        """
+        cursor.execute(
+            """WITH RECURSIVE tree(relid) AS (
+                    SELECT unnest(%(sources)s::regclass[])::oid
+                    UNION
+                    SELECT i.inhrelid FROM pg_inherits i
+                    INNER JOIN tree ON i.inhparent=tree.relid)
+                SELECT c.oid::bigint, c.oid::regclass::text, c.relfilenode::bigint, c.relkind::text
+                FROM tree
+                INNER JOIN pg_class c ON c.oid=tree.relid
+                ORDER BY 2;""",
+            {"sources": self.sources},
+        )
+        return cursor.fetchall()
+
+    def install_source_triggers(self, cursor):
+        """
+        Creates the triggers logging the changes of the sources (and of their partitions) in _derived_sources_changes, if missing
+        """
+        for oid, name, relfilenode, relkind in self.get_sources_tree(cursor=cursor):
+            if relkind not in ("r", "p"):
+                continue
+            cursor.execute(
+                """SELECT COUNT(*) FROM pg_trigger
+                    WHERE tgrelid=%s AND tgname='_dbf_source_changes';""",
+                (oid,),
+            )
+            if cursor.fetchone()[0] == 0:
+                # checking again once the table is locked, in case of a concurrent refresh installing it
+                cursor.execute(
+                    sql.SQL("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE;").format(
+                        table_identifier(name)
+                    )
+                )
+                cursor.execute(
+                    """SELECT COUNT(*) FROM pg_trigger
+                        WHERE tgrelid=%s AND tgname='_dbf_source_changes';""",
+                    (oid,),
+                )
+                if cursor.fetchone()[0] > 0:
+                    continue
+                cursor.execute(
+                    sql.SQL(
+                        """CREATE TRIGGER _dbf_source_changes
+                            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {}
+                            FOR EACH STATEMENT EXECUTE FUNCTION _dbf_log_source_change();"""
+                    ).format(table_identifier(name))
+                )
+
+    def get_sources_signature(self, cursor):
+        signature = []
+        for oid, name, relfilenode, relkind in self.get_sources_tree(cursor=cursor):
+            cursor.execute(
+                """SELECT SUM(weight)::bigint, MAX(id) FROM _derived_sources_changes
+                    WHERE source_oid=%s;""",
+                (oid,),
+            )
+            signature.append([name, relfilenode] + list(cursor.fetchone()))
+        return hashlib.sha256(json.dumps(signature).encode("utf-8")).hexdigest()
+
+    def compact_changes(self, cursor):
+        """
+        Merges the logged changes of the sources into one row per source, keeping their total weight and last id (and so the signatures),
+        and removes the changes of dropped tables. Rows locked by concurrent compactions are skipped.
+        """
+        cursor.execute(
+            """DELETE FROM _derived_sources_changes l
+                WHERE NOT EXISTS (SELECT 1 FROM pg_class c WHERE c.oid=l.source_oid);"""
+        )
+        cursor.execute(
+            """WITH deleted AS (
+                    DELETE FROM _derived_sources_changes WHERE ctid IN (
+                        SELECT ctid FROM _derived_sources_changes
+                        WHERE source_oid=ANY(%s::oid[])
+                        FOR UPDATE SKIP LOCKED)
+                    RETURNING id, source_oid, weight)
+                INSERT INTO _derived_sources_changes(id,source_oid,weight)
+                SELECT MAX(id), source_oid, SUM(weight) FROM deleted GROUP BY source_oid;""",
+            ([r[0] for r in self.get_sources_tree(cursor=cursor)],),
+        )
+
+    def needs_refresh(self, cursor, signature):
+        if self.force:
+            return True
+        cursor.execute("SELECT to_regclass(%s) IS NULL;", (self.table,))
+        if cursor.fetchone()[0]:
+            return True
+        cursor.execute(
+            "SELECT sources_signature,query_hash FROM _derived_tables_info WHERE table_name=%s;",
+            (self.table,),
+        )
+        if cursor.fetchone() != (signature, self.get_query_hash()):
+            return True
+        cursor.execute(
+            """SELECT COUNT(*) FROM _fillers_info
+                WHERE class=%s AND args=%s AND status='end_apply';""",
+            (self.__class__.__name__, self.get_relevant_attr_string()),
+        )
+        return cursor.fetchone()[0] == 0
+
+    def refresh(self, connection):
+        """
+        Refreshes the derived table if needed (see needs_refresh) on the given connection, and commits.
+        Returns True if the table was refreshed.
+        """
+        with connection.cursor() as cursor:
+            self.install_source_triggers(cursor=cursor)
+            # releasing the locks taken to install triggers
+            connection.commit()
+            signature = self.get_sources_signature(cursor=cursor)
+            if not self.needs_refresh(cursor=cursor, signature=signature):
+                self.logger.info(f"Sources of {self.table} unchanged, skipping refresh")
+                connection.rollback()
+                return False
+            cursor.execute(
+                "SELECT query_hash FROM _derived_tables_info WHERE table_name=%s;",
+                (self.table,),
+            )
+            stored = cursor.fetchone()
+            query_changed = stored is None or stored[0] != self.get_query_hash()
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (self.table,))
+            exists = cursor.fetchone()[0]
+            kind = "MATERIALIZED VIEW" if self.materialized_view else "TABLE"
+            if exists and query_changed:
+                self.logger.info(f"Query of {self.table} changed, recreating it")
+                cursor.execute(
+                    sql.SQL("DROP {} {};").format(
+                        sql.SQL(kind), table_identifier(self.table)
+                    )
+                )
+                exists = False
+            if not exists:
+                cursor.execute(
+                    sql.SQL("CREATE {} {} AS {};").format(
+                        sql.SQL(kind), table_identifier(self.table), sql.SQL(self.query)
+                    )
+                )
+                if self.unique_columns is not None:
+                    cursor.execute(
+                        sql.SQL("CREATE UNIQUE INDEX ON {} ({});").format(
+                            table_identifier(self.table),
+                            sql.SQL(",").join(
+                                [sql.Identifier(c) for c in self.unique_columns]
+                            ),
+                        )
+                    )
+            elif self.materialized_view:
+                cursor.execute(
+                    """SELECT EXISTS (SELECT 1 FROM pg_index
+                            WHERE indrelid=%(table)s::regclass AND indisunique AND indpred IS NULL)
+                        AND (SELECT ispopulated FROM pg_matviews
+                            WHERE format('%%I.%%I',schemaname,matviewname)::regclass=%(table)s::regclass);""",
+                    {"table": self.table},
+                )
+                concurrently = cursor.fetchone()[0]
+                cursor.execute(
+                    sql.SQL("REFRESH MATERIALIZED VIEW {}{};").format(
+                        sql.SQL("CONCURRENTLY " if concurrently else ""),
+                        table_identifier(self.table),
+                    )
+                )
+            else:
+                cursor.execute(
+                    sql.SQL("TRUNCATE TABLE {}; INSERT INTO {} {};").format(
+                        table_identifier(self.table),
+                        table_identifier(self.table),
+                        sql.SQL(self.query),
+                    )
+                )
+            cursor.execute(
+                """INSERT INTO _derived_tables_info(table_name,sources_signature,query_hash)
+                    VALUES (%s,%s,%s)
+                    ON CONFLICT (table_name) DO UPDATE SET
+                        sources_signature=EXCLUDED.sources_signature,
+                        query_hash=EXCLUDED.query_hash,
+                        refreshed_at=CURRENT_TIMESTAMP;""",
+                (self.table, signature, self.get_query_hash()),
+            )
+            # for the derived tables using this one as source
+            cursor.execute(
+                "INSERT INTO _derived_sources_changes(source_oid) VALUES (%s::regclass);",
+                (self.table,),
+            )
+            self.compact_changes(cursor=cursor)
+        connection.commit()
+        self.logger.info(f"Refreshed {self.table}")
+        return True
+
+
+class DerivedTablesFiller(Filler):
+    """
+    A filler refreshing several DerivedTableFiller, independent ones in parallel (each on its own connection).
+    Derived tables used as sources of other ones are refreshed first.
+    """
+
+    def __init__(self, fillers, workers=4, **kwargs):
+        Filler.__init__(self, **kwargs)
+        self.fillers = list(fillers)
+        self.workers = workers
+        self.relevant_attributes = ["workers"]
+
+    def after_insert(self):
+        for f in self.fillers:
+            f.db = self.db
+            f.logger = self.logger
+            f.after_insert()
+
+    def prepare(self):
+        Filler.prepare(self)
+        for f in self.fillers:
+            f.prepare()
+
+    def copy_for_db(self, db):
+        ans = Filler.copy_for_db(self, db)
+        ans.fillers = [f.copy_for_db(db) for f in self.fillers]
+        return ans
+
+    def get_waves(self):
+        """
+        Groups the fillers in successive waves of fillers independent from each other
+        """
+        tables = {f.table for f in self.fillers}
+        done = set()
+        waves = []
+        remaining = list(self.fillers)
+        while len(remaining):
+            wave = [
+                f
+                for f in remaining
+                if all(s in done or s not in tables for s in f.sources)
+            ]
+            if not len(wave):
+                raise ValueError(
+                    f"Circular dependencies between derived tables: {[f.table for f in remaining]}"
+                )
+            waves.append(wave)
+            done.update(f.table for f in wave)
+            remaining = [f for f in remaining if f not in wave]
+        return waves
+
+    def apply(self):
+        for wave in self.get_waves():
+            if self.workers <= 1 or len(wave) == 1:
+                for f in wave:
+                    f.refresh(connection=self.db.connection)
+            else:
+
+                def refresh(f):
+                    connection = self.db.new_connection()
+                    try:
+                        return f.refresh(connection=connection)
+                    finally:
+                        connection.close()
+
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    futures = [executor.submit(refresh, f) for f in wave]
+                errors = []
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(e)
+                if len(errors):
+                    raise Exception(
+                        f"Errors when refreshing derived tables:{[(e.__class__,str(e)) for e in errors]}"
+                    )
+            for f in wave:
+                f.done = True
+                f.post_apply()
+                self.db.register_filler_content(
+                    filler_class=f.__class__.__name__,
+                    filler_args=f.get_relevant_attr_string(),
+                    status="end_apply",
+                )
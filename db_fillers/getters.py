@@ -1,13 +1,20 @@
 import os
+import io
+import copy
 import requests
 import zipfile
 import pandas as pd
 import logging
 import csv
-from psycopg2 import extras
+import numpy as np
+import psycopg2.extensions
+from psycopg2 import extras, sql
+from psycopg2.extensions import encodings as pg_encodings
 import shapefile
 import json
 import subprocess
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 
 logger = logging.getLogger(__name__)
@@ -19,6 +26,59 @@ logger.addHandler(ch)
 logger.setLevel(logging.INFO)
 
 
+@contextlib.contextmanager
+def iso_datestyle(cursor):
+    """
+    Sets the ISO DateStyle on the session of cursor within the block (restoring it after), so that dates and timestamps
+    are parsed correctly whatever the DateStyle of the database (e.g. PostgreSQL,European set by init_db)
+    """
+    cursor.execute("SHOW DateStyle;")
+    datestyle = cursor.fetchone()[0]
+    if not datestyle.startswith("ISO"):
+        cursor.execute("SET DateStyle TO ISO;")
+    try:
+        yield
+    finally:
+        # in a failed transaction, SET would fail and hide the error of the block (and is rolled back with it anyway)
+        failed = (
+            getattr(cursor.connection, "get_transaction_status", lambda: None)()
+            == psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        )
+        if not datestyle.startswith("ISO") and not failed:
+            cursor.execute("SET DateStyle TO %s;", (datestyle,))
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling of a series sorted by x: returns the indices of the n_out points
+    (first and last included) that best preserve the visual shape of the series.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        raise ValueError(f"LTTB needs at least 3 output points, got {n_out}")
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
 class Getter(object):
     """
     The Getter class and its children provide methods to extract data from the database, e.g. in the form of DataFrames.
@@ -30,6 +90,21 @@ class Getter(object):
     """
 
     columns = None
+    # Optional dtype hints per column for the COPY fast path, e.g. {"value": "float64", "date": "datetime64[ns]"}
+    dtypes = None
+    # COPY fast path (see get_copy): None lets the caller enable it with get_result(copy_fastpath=True),
+    # True enables it by default, False opts out (e.g. when parse_results does more than passing rows through)
+    copy_fastpath = None
+    # Use server-side prepared statements (see Database.prepared_statements), to avoid re-planning the query
+    # when the getter is called repeatedly with different query_attributes()
+    prepared = False
+    # For queries on partitioned tables: dict query attribute name -> partition key column, see partition_filter
+    partition_keys = None
+    # Columns of the output of query() used by plot_result with mode="bucket", "grid" or "lttb":
+    # plot_x (str), plot_y (str or list of str), and optionally plot_series (str) to draw one line per value
+    plot_x = None
+    plot_y = None
+    plot_series = None
 
     def __init__(self, db=None, name=None, data_folder=None):  # ,file_info=None):
         if name is None:
@@ -54,9 +129,37 @@ class Getter(object):
     def prepare(self):
         pass
 
-    def get(self, db, raw_result=False, **kwargs):
-        db.cursor.execute(self.query(), self.query_attributes())
-        query_result = list(db.cursor.fetchall())
+    def get(
+        self,
+        db,
+        raw_result=False,
+        cursor=None,
+        copy_fastpath=None,
+        prepared=None,
+        **kwargs,
+    ):
+        """
+        cursor can be provided to run the query on another connection than the main one of db (see GetterGroup)
+        """
+        if cursor is None:
+            cursor = db.cursor
+        if self.copy_fastpath is False or raw_result:
+            copy_fastpath = False
+        elif copy_fastpath is None:
+            copy_fastpath = bool(self.copy_fastpath)
+        if copy_fastpath:
+            df = self.get_copy(cursor=cursor)
+            self.cleanup()
+            return df
+        if prepared is None:
+            prepared = self.prepared
+        if prepared and db.backend.prepared_statements:
+            db.prepared_statements.execute(
+                cursor, self.query(), self.query_attributes()
+            )
+        else:
+            cursor.execute(self.query(), self.query_attributes())
+        query_result = list(cursor.fetchall())
         self.cleanup()
         if raw_result:
             return query_result
@@ -66,6 +169,40 @@ class Getter(object):
             )
             return df
 
+    def get_copy(self, cursor):
+        """
+        Fast path: runs the query as COPY (...) TO STDOUT into an in-memory CSV buffer, parsed by the pandas C reader.
+        Rows do not go through parse_results, columns are typed with self.dtypes when provided.
+        NULLs and empty strings both come back as missing values.
+        """
+        query = cursor.mogrify(self.query(), self.query_attributes()).strip()
+        if query.endswith(b";"):
+            query = query[:-1]
+        buffer = io.BytesIO()
+        with iso_datestyle(cursor):
+            cursor.copy_expert(
+                b"COPY (" + query + b") TO STDOUT WITH (FORMAT CSV, HEADER TRUE)",
+                buffer,
+            )
+        buffer.seek(0)
+
+        dtypes = dict(self.dtypes) if self.dtypes is not None else {}
+        parse_dates = [c for c, t in dtypes.items() if str(t).startswith("datetime")]
+        for c in parse_dates:
+            del dtypes[c]
+        return pd.read_csv(
+            buffer,
+            header=0,
+            names=self.columns,
+            dtype=dtypes if len(dtypes) else None,
+            parse_dates=parse_dates if len(parse_dates) else False,
+            true_values=["t"],
+            false_values=["f"],
+            keep_default_na=False,
+            na_values=[""],
+            encoding=pg_encodings.get(cursor.connection.encoding, "utf-8"),
+        )
+
     def query(self):
         """
         query string with %(variablename)s convention
@@ -78,15 +215,238 @@ class Getter(object):
         """
         raise NotImplementedError
 
+    def partition_filter(self, alias=None):
+        """
+        SQL condition on the partition keys (see partition_keys) for which a value is provided in query_attributes(),
+        to be included in the WHERE clause of query() so that PostgreSQL prunes the other partitions.
+        """
+        if self.partition_keys is None:
+            return "TRUE"
+        attributes = self.query_attributes()
+        conditions = []
+        for attr, column in self.partition_keys.items():
+            if attributes.get(attr) is not None:
+                column = column if alias is None else f"{alias}.{column}"
+                conditions.append(f"{column} = %({attr})s")
+        if len(conditions):
+            return " AND ".join(conditions)
+        else:
+            return "TRUE"
+
     def parse_results(self, query_result):
         """
         returns list of elements to be used for pandas or geopandas
         """
         raise NotImplementedError
 
-    def plot_result(self, show=True, outfile=None, plot_kwargs={}, **kwargs):
-        df = self.get_result(**kwargs)
-        ax = df.plot(**plot_kwargs)
+    plot_aggregates = ("avg", "min", "max", "sum", "count")
+
+    def get_plot_columns(self):
+        if self.plot_x is None or self.plot_y is None:
+            raise ValueError(
+                f"plot_x and plot_y have to be set for getter {self.name} to use plot modes"
+            )
+        plot_y = [self.plot_y] if isinstance(self.plot_y, str) else list(self.plot_y)
+        return self.plot_x, plot_y, self.plot_series
+
+    def get_plot_data(
+        self, mode="bucket", max_points=1000, aggregate="avg", db=None, **kwargs
+    ):
+        """
+        Result of the getter reduced to at most ~max_points points per series, for plotting:
+        - "bucket": time (or numeric) bucketing by PostgreSQL, on max_points buckets of plot_x, aggregating plot_y with aggregate
+        - "grid": 2D binning of (plot_x, first plot_y) by PostgreSQL, on a grid of ~max_points cells, with a count per cell
+        - "lttb": full result downsampled on the client with LTTB, preserving the shape of the series
+        """
+        if mode not in ("bucket", "grid", "lttb"):
+            raise ValueError(
+                f"Unknown plot mode: {mode}, should be bucket, grid, lttb or None"
+            )
+        if mode != "lttb" and aggregate not in self.plot_aggregates:
+            raise ValueError(
+                f"Unknown aggregate: {aggregate}, should be in {self.plot_aggregates}"
+            )
+        if db is None:
+            db = self.db
+        if db is None:
+            raise ValueError("please set a database to query from")
+        if mode == "lttb":
+            with iso_datestyle(db.cursor):
+                df = self.get_result(db=db, **kwargs)
+            return self.downsample(df, max_points=max_points)
+        self.prepare()
+        plot_x, plot_y, plot_series = self.get_plot_columns()
+        if mode == "grid":
+            plot_y = plot_y[:1]
+        inner = sql.SQL(self.query().strip().rstrip(";"))
+        x = sql.Identifier(plot_x)
+        series = [] if plot_series is None else [sql.Identifier(plot_series)]
+
+        db.cursor.execute(
+            sql.SQL("WITH _plot_query AS (")
+            + inner
+            + sql.SQL(") SELECT {} FROM _plot_query LIMIT 0;").format(x),
+            self.query_attributes(),
+        )
+        type_code = db.cursor.description[0].type_code
+        temporal = type_code in (
+            psycopg2.extensions.PYDATE.values
+            + psycopg2.extensions.PYDATETIME.values
+            + psycopg2.extensions.PYDATETIMETZ.values
+        )
+        if temporal:
+            xv = sql.SQL("EXTRACT(EPOCH FROM {})").format(x)
+        else:
+            xv = sql.SQL("{}::DOUBLE PRECISION").format(x)
+
+        if mode == "bucket":
+            n_buckets = max_points
+            bounds = sql.SQL("MIN({xv}) AS xlo, MAX({xv}) AS xhi").format(xv=xv)
+            buckets = [
+                sql.SQL("width_bucket({},xlo,xhi,{})").format(
+                    xv, sql.Literal(n_buckets)
+                )
+            ]
+            values = [
+                sql.SQL("{}({}){} AS {}").format(
+                    sql.SQL(aggregate.upper()),
+                    sql.Identifier(y),
+                    sql.SQL(
+                        "::DOUBLE PRECISION" if aggregate in ("avg", "sum") else ""
+                    ),
+                    sql.Identifier(y),
+                )
+                for y in plot_y
+            ]
+            conditions = sql.SQL("xhi>xlo")
+        else:
+            n_buckets = max(int(max_points**0.5), 1)
+            y = sql.Identifier(plot_y[0])
+            yv = sql.SQL("{}::DOUBLE PRECISION").format(y)
+            bounds = sql.SQL(
+                "MIN({xv}) AS xlo, MAX({xv}) AS xhi, MIN({yv}) AS ylo, MAX({yv}) AS yhi"
+            ).format(xv=xv, yv=yv)
+            buckets = [
+                sql.SQL("width_bucket({},xlo,xhi,{})").format(
+                    xv, sql.Literal(n_buckets)
+                ),
+                sql.SQL("width_bucket({},ylo,yhi,{})").format(
+                    yv, sql.Literal(n_buckets)
+                ),
+            ]
+            values = [
+                sql.SQL("AVG({})::DOUBLE PRECISION AS {}").format(y, y),
+                sql.SQL("COUNT(*) AS count"),
+            ]
+            conditions = sql.SQL("xhi>xlo AND yhi>ylo")
+
+        query = (
+            sql.SQL("WITH _plot_query AS (")
+            + inner
+            + sql.SQL(
+                """), _plot_bounds AS (SELECT {bounds} FROM _plot_query)
+            SELECT {columns} FROM _plot_query, _plot_bounds
+            WHERE {x} IS NOT NULL
+            GROUP BY {group}
+            ORDER BY {order};"""
+            ).format(
+                bounds=bounds,
+                columns=sql.SQL(",").join(
+                    series + [sql.SQL("MIN({}) AS {}").format(x, x)] + values
+                ),
+                x=x,
+                group=sql.SQL(",").join(
+                    series
+                    + [
+                        sql.SQL("CASE WHEN {} THEN {} ELSE 0 END").format(conditions, b)
+                        for b in buckets
+                    ]
+                ),
+                order=sql.SQL(",").join(series + [x]),
+            )
+        )
+        with iso_datestyle(db.cursor):
+            db.cursor.execute(query, self.query_attributes())
+            columns = [d[0] for d in db.cursor.description]
+            df = pd.DataFrame(db.cursor.fetchall(), columns=columns)
+        self.cleanup()
+        return df
+
+    def downsample(self, df, max_points=1000):
+        """
+        LTTB downsampling of a result to at most max_points points per series and y column
+        """
+        plot_x, plot_y, plot_series = self.get_plot_columns()
+        if plot_series is None:
+            groups = [df]
+        else:
+            groups = [g for _, g in df.groupby(plot_series, sort=False)]
+        ans = []
+        for g in groups:
+            g = g.dropna(subset=[plot_x]).sort_values(plot_x)
+            x = g[plot_x]
+            if pd.api.types.is_datetime64_any_dtype(x):
+                x = x.astype("int64")
+            indices = set()
+            for y in plot_y:
+                valid = g[y].notna().to_numpy()
+                positions = np.flatnonzero(valid)
+                indices.update(
+                    positions[lttb(x[valid], g[y][valid], max_points)].tolist()
+                )
+            ans.append(g.iloc[sorted(indices)])
+        if len(ans):
+            return pd.concat(ans)
+        else:
+            return df
+
+    def plot_result(
+        self,
+        show=True,
+        outfile=None,
+        plot_kwargs={},
+        mode=None,
+        max_points=1000,
+        aggregate="avg",
+        **kwargs,
+    ):
+        """
+        Plots the result of the getter. With mode=None the full result is plotted,
+        otherwise it is reduced to ~max_points points per series first (see get_plot_data).
+        """
+        if mode is None:
+            df = self.get_result(**kwargs)
+            ax = df.plot(**plot_kwargs)
+        else:
+            df = self.get_plot_data(
+                mode=mode, max_points=max_points, aggregate=aggregate, **kwargs
+            )
+            plot_x, plot_y, plot_series = self.get_plot_columns()
+            fig, ax = plt.subplots()
+            if plot_series is None:
+                groups = [(None, df)]
+            else:
+                groups = list(df.groupby(plot_series, sort=False))
+            for name, g in groups:
+                if mode == "grid":
+                    g.plot.scatter(
+                        x=plot_x,
+                        y=plot_y[0],
+                        s=10 + 90 * g["count"] / max(df["count"].max(), 1),
+                        label=name,
+                        ax=ax,
+                        **plot_kwargs,
+                    )
+                else:
+                    g.plot(
+                        x=plot_x,
+                        y=plot_y,
+                        label=(
+                            plot_y if name is None else [f"{name} {y}" for y in plot_y]
+                        ),
+                        ax=ax,
+                        **plot_kwargs,
+                    )
         if outfile is not None:
             plt.savefig(outfile)
         if show:
@@ -99,3 +459,82 @@ class Getter(object):
         In case some operations are needed after the query (e.g. dropping temp tables)
         """
         pass
+
+
+class GetterGroup(object):
+    """
+    Runs several getters at once and returns a dict of their results, keyed by getter name.
+    Each getter is run on its own connection taken from the pool of the database (see Database.get_pool),
+    so that the group takes the time of its slowest query rather than the sum of all of them.
+    With workers=1, getters are run one after the other on the main cursor of the database.
+    """
+
+    def __init__(self, getters, db=None):
+        self.getters = list(getters)
+        self.db = db
+        names = [g.name for g in self.getters]
+        duplicates = sorted(set(n for n in names if names.count(n) > 1))
+        if len(duplicates):
+            raise ValueError(
+                f"Getter names have to be unique within a GetterGroup, duplicates: {duplicates}"
+            )
+        self.logger = logging.getLogger(
+            "{}.{}".format(__name__, self.__class__.__name__)
+        )
+        self.logger.addHandler(ch)
+        self.logger.setLevel(logging.INFO)
+
+    def get_results(self, db=None, workers=4, **kwargs):
+        if db is None:
+            db = self.db
+        if db is None:
+            raise ValueError("please set a database to query from")
+        if workers is None:
+            workers = len(self.getters)
+        workers = min(workers, len(self.getters))
+        if workers <= 1:
+            return {g.name: g.get_result(db=db, **kwargs) for g in self.getters}
+
+        pool = db.get_pool(maxconn=workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                g.name: executor.submit(
+                    self.get_pooled, getter=g, db=db, pool=pool, **kwargs
+                )
+                for g in self.getters
+            }
+        results = {}
+        errors = []
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors.append((name, e))
+        if len(errors):
+            raise Exception(
+                f"Errors in getters of GetterGroup:{[(n,e.__class__,str(e)) for n,e in errors]}"
+            )
+        return results
+
+    def get_pooled(self, getter, db, pool, **kwargs):
+        """
+        Runs a getter on a connection of the pool: a copy of the getter is bound to a view of the database on that connection,
+        so that its prepare and cleanup steps (e.g. temp tables) run on the same connection as its query
+        """
+        connection = pool.getconn()
+        try:
+            view = db.get_view(connection)
+            pooled_getter = copy.copy(getter)
+            pooled_getter.db = view
+            try:
+                result = pooled_getter.get_result(db=view, **kwargs)
+            finally:
+                view.cursor.close()
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            pool.putconn(connection)
+        self.logger.debug(f"GetterGroup: got result of {getter.name}")
+        return result
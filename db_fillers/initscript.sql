@@ -24,3 +24,49 @@ class TEXT,
 args TEXT,
 status TEXT
 );
+
+CREATE TABLE IF NOT EXISTS _fillers_changes(
+id BIGSERIAL PRIMARY KEY,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+class TEXT,
+args TEXT,
+table_name TEXT,
+inserted BIGINT,
+updated BIGINT,
+deleted BIGINT
+);
+
+CREATE TABLE IF NOT EXISTS _derived_tables_info(
+table_name TEXT PRIMARY KEY,
+sources_signature TEXT,
+query_hash TEXT,
+refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS _derived_sources_changes(
+id BIGSERIAL,
+source_oid OID NOT NULL,
+weight BIGINT NOT NULL DEFAULT 1
+);
+
+CREATE INDEX IF NOT EXISTS _derived_sources_changes_idx ON _derived_sources_changes(source_oid,id);
+
+CREATE OR REPLACE FUNCTION _dbf_log_source_change() RETURNS TRIGGER AS $$
+BEGIN
+INSERT INTO _derived_sources_changes(source_oid) VALUES (TG_RELID);
+RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TABLE IF NOT EXISTS _fillers_memory(
+id BIGSERIAL PRIMARY KEY,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+class TEXT,
+args TEXT,
+step TEXT,
+rss_start BIGINT,
+rss_peak BIGINT,
+rss_peak_delta BIGINT,
+duration DOUBLE PRECISION,
+top_allocations TEXT
+);
\ No newline at end of file
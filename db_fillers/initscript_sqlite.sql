@@ -0,0 +1,52 @@
+CREATE TABLE IF NOT EXISTS data_sources(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+name TEXT NOT NULL UNIQUE
+);
+
+
+
+CREATE TABLE IF NOT EXISTS _exec_info(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+content TEXT,
+content_hash TEXT
+);
+
+CREATE TABLE IF NOT EXISTS _fillers_info(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+class TEXT,
+args TEXT,
+status TEXT
+);
+
+CREATE TABLE IF NOT EXISTS _fillers_changes(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+class TEXT,
+args TEXT,
+table_name TEXT,
+inserted BIGINT,
+updated BIGINT,
+deleted BIGINT
+);
+
+CREATE TABLE IF NOT EXISTS _derived_tables_info(
+table_name TEXT PRIMARY KEY,
+sources_signature TEXT,
+query_hash TEXT,
+refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS _fillers_memory(
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+exec_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+class TEXT,
+args TEXT,
+step TEXT,
+rss_start BIGINT,
+rss_peak BIGINT,
+rss_peak_delta BIGINT,
+duration DOUBLE PRECISION,
+top_allocations TEXT
+);
\ No newline at end of file
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import ctypes
+import logging
+import threading
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger.setLevel(logging.INFO)
+
+
+class MemoryLimitExceeded(BaseException):
+    """
+    Raised in a thread tracked by a MemoryTracker when the RSS of the process exceeds the hard limit.
+    Derives from BaseException (like KeyboardInterrupt) so that it is not swallowed by except Exception clauses of fillers.
+    """
+
+    pass
+
+
+def get_rss():
+    """
+    Current resident set size of the process, in bytes
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # no procfs: falling back on the peak RSS of the process (kilobytes on Linux, bytes on macOS)
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+class MemoryTracker(object):
+    """
+    Context manager tracking the memory used by a block of code (e.g. the prepare or apply step of a filler),
+    by sampling the RSS of the process every interval seconds in a background thread.
+    After exit, rss_start, rss_peak and rss_peak_delta (bytes) are available, and, if tracemalloc_top>0,
+    top_allocations lists the tracemalloc statistics of the lines of code that allocated the most memory within the block.
+
+    Limits are in bytes of RSS: above soft_limit a warning is logged; above hard_limit MemoryLimitExceeded is raised in the
+    tracked thread, so that the block can be aborted cleanly (e.g. with a rollback) before the process gets killed.
+    The exception is raised asynchronously: code running in a long C call (e.g. within numpy) is only interrupted when it returns.
+    It is raised once, so that the cleanup of the block (finally clauses, rollbacks) is not interrupted; if it is swallowed,
+    it is raised again when the block exits.
+    """
+
+    def __init__(
+        self,
+        soft_limit=None,
+        hard_limit=None,
+        interval=0.1,
+        tracemalloc_top=0,
+        label="",
+    ):
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.interval = interval
+        self.tracemalloc_top = tracemalloc_top
+        self.label = label
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.active = False
+        self.soft_limit_warned = False
+        self.aborted = False
+        self.top_allocations = []
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.start_time = time.time()
+        if self.tracemalloc_top:
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            self.snapshot_start = tracemalloc.take_snapshot()
+        self.rss_start = get_rss()
+        self.rss_peak = self.rss_start
+        self.active = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.active = False
+            if self.aborted:
+                # clearing the exception if not delivered yet (raised below if the block ended normally)
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_ulong(self.thread_id), None
+                )
+        self.stop_event.set()
+        self.sampler.join()
+        self.rss_peak = max(self.rss_peak, get_rss())
+        self.rss_peak_delta = self.rss_peak - self.rss_start
+        self.duration = time.time() - self.start_time
+        if self.tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.snapshot_start, "lineno")
+            self.top_allocations = [str(s) for s in stats[: self.tracemalloc_top]]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        if self.aborted and exc_type is None:
+            raise MemoryLimitExceeded(self.get_abort_message())
+        return False
+
+    def get_abort_message(self):
+        return f"Memory hard limit exceeded for {self.label}: RSS {self.rss_peak/2**20:.0f} MB > {self.hard_limit/2**20:.0f} MB"
+
+    def sample(self):
+        while not self.stop_event.is_set():
+            rss = get_rss()
+            self.rss_peak = max(self.rss_peak, rss)
+            if (
+                self.soft_limit is not None
+                and rss > self.soft_limit
+                and not self.soft_limit_warned
+            ):
+                self.soft_limit_warned = True
+                self.logger.warning(
+                    f"Memory soft limit exceeded for {self.label}: RSS {rss/2**20:.0f} MB > {self.soft_limit/2**20:.0f} MB"
+                )
+            if self.hard_limit is not None and rss > self.hard_limit:
+                with self.lock:
+                    if self.active and not self.aborted:
+                        self.aborted = True
+                        self.logger.error(self.get_abort_message())
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                            ctypes.c_ulong(self.thread_id),
+                            ctypes.py_object(MemoryLimitExceeded),
+                        )
+                return
+            self.stop_event.wait(self.interval)
@@ -0,0 +1,138 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger.setLevel(logging.INFO)
+
+
+class WriteController(object):
+    """
+    Write-rate controller for the bulk helpers of fillers (Filler.execute_batch, Database.write_dataframe, Filler.stream_csv),
+    so that loads on a production primary go as fast as the cluster tolerates instead of using a fixed page size.
+
+    - The batch size adapts to the observed latency of write statements: it grows while batches take less than target_latency
+      seconds, and shrinks when they take more (by a factor target_latency/latency, bounded to [0.5,1.5] per batch).
+    - Writes are throttled to max_rows_per_sec and max_bytes_per_sec (bytes are only known for COPY paths).
+    - If max_replica_lag (seconds) is set and a cursor is provided, replication lag is checked every lag_check_interval seconds
+      (pg_stat_replication, visible to superusers or members of pg_monitor), and writes are paused while it is above the limit.
+    - should_commit() returns True every commit_every batches.
+    """
+
+    def __init__(
+        self,
+        batch_size=1000,
+        min_batch_size=10,
+        max_batch_size=100000,
+        target_latency=0.5,
+        max_rows_per_sec=None,
+        max_bytes_per_sec=None,
+        commit_every=None,
+        max_replica_lag=None,
+        lag_check_interval=5.0,
+        cursor=None,
+    ):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_rows_per_sec = max_rows_per_sec
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.commit_every = commit_every
+        self.max_replica_lag = max_replica_lag
+        self.lag_check_interval = lag_check_interval
+        self.cursor = cursor
+        self.logger = logger
+        self.reset()
+
+    def reset(self):
+        self.start_time = None
+        self.rows = 0
+        self.bytes = 0
+        self.batches_since_commit = 0
+        self.last_lag_check = None
+
+    def batches(self, rows):
+        """
+        Generator of lists of rows, of the current batch size
+        """
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if len(batch):
+            yield batch
+
+    def record(self, rows, seconds, nbytes=0):
+        """
+        Records a written batch: adapts the batch size to its latency, and sleeps as needed to respect rate limits and replica lag
+        """
+        if self.start_time is None:
+            self.start_time = time.time() - seconds
+        self.rows += rows
+        self.bytes += nbytes
+        self.batches_since_commit += 1
+
+        if self.target_latency is not None and rows > 0:
+            if seconds > 0:
+                factor = min(max(self.target_latency / seconds, 0.5), 1.5)
+            else:
+                factor = 1.5
+            self.batch_size = int(
+                min(
+                    max(self.batch_size * factor, self.min_batch_size),
+                    self.max_batch_size,
+                )
+            )
+
+        wait = 0
+        elapsed = time.time() - self.start_time
+        if self.max_rows_per_sec is not None:
+            wait = max(wait, self.rows / self.max_rows_per_sec - elapsed)
+        if self.max_bytes_per_sec is not None:
+            wait = max(wait, self.bytes / self.max_bytes_per_sec - elapsed)
+        if wait > 0:
+            time.sleep(wait)
+        self.wait_replica_lag()
+
+    def should_commit(self):
+        if (
+            self.commit_every is not None
+            and self.batches_since_commit >= self.commit_every
+        ):
+            self.batches_since_commit = 0
+            return True
+        else:
+            return False
+
+    def get_replica_lag(self):
+        self.cursor.execute(
+            """SELECT COALESCE(MAX(EXTRACT(EPOCH FROM replay_lag)),0) FROM pg_stat_replication;"""
+        )
+        return float(self.cursor.fetchone()[0])
+
+    def wait_replica_lag(self):
+        if self.max_replica_lag is None or self.cursor is None:
+            return
+        now = time.time()
+        if (
+            self.last_lag_check is not None
+            and now - self.last_lag_check < self.lag_check_interval
+        ):
+            return
+        self.last_lag_check = now
+        lag = self.get_replica_lag()
+        while lag > self.max_replica_lag:
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+            self.logger.info(
+                f"Replica lag {lag:.1f}s above {self.max_replica_lag}s, pausing writes, batch size reduced to {self.batch_size}"
+            )
+            time.sleep(self.lag_check_interval)
+            lag = self.get_replica_lag()
+        self.last_lag_check = time.time()
@@ -1,6 +1,10 @@
 import pytest
 import os
 import glob
+import csv
+import io
+import time
+from matplotlib import pyplot as plt
 
 import db_fillers as dbf
 from db_fillers import fillers
@@ -116,3 +120,1091 @@ def test_coalescefiller3(maindb, tmpdir):
 def test_coalescefiller4(maindb, tmpdir):
     maindb.add_filler(fillers.CoalesceFiller(fillers=[]))
     maindb.fill_db()
+
+
+class ExampleGetter(dbf.Getter):
+    columns = ["value"]
+
+    def __init__(self, value=1, **kwargs):
+        dbf.Getter.__init__(self, **kwargs)
+        self.value = value
+
+    def query(self):
+        return "SELECT %(value)s::INT AS value;"
+
+    def query_attributes(self):
+        return {"value": self.value}
+
+    def parse_results(self, query_result):
+        return query_result
+
+
+def test_getter(maindb):
+    df = ExampleGetter(value=3, db=maindb).get_result()
+    assert list(df["value"]) == [3]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_get_many(maindb, workers):
+    getters = [ExampleGetter(value=i, name=f"getter_{i}") for i in range(10)]
+    results = maindb.get_many(getters, workers=workers)
+    assert sorted(results.keys()) == sorted(g.name for g in getters)
+    for i in range(10):
+        assert list(results[f"getter_{i}"]["value"]) == [i]
+    maindb.close_pool()
+
+
+def test_getter_group_names(maindb):
+    with pytest.raises(ValueError):
+        dbf.GetterGroup(getters=[ExampleGetter(), ExampleGetter()], db=maindb)
+
+
+class ExampleTempTableGetter(ExampleGetter):
+    def prepare(self):
+        self.db.cursor.execute(
+            "CREATE TEMP TABLE temp_values AS SELECT generate_series(1,%(value)s) AS value;",
+            {"value": self.value},
+        )
+
+    def query(self):
+        return "SELECT SUM(value) AS value FROM temp_values;"
+
+    def cleanup(self):
+        self.db.cursor.execute("DROP TABLE temp_values;")
+
+
+def test_get_many_temp_tables(maindb):
+    getters = [
+        ExampleTempTableGetter(value=i, name=f"getter_{i}", db=maindb)
+        for i in range(1, 9)
+    ]
+    results = maindb.get_many(getters, workers=4)
+    assert [results[f"getter_{i}"]["value"][0] for i in range(1, 9)] == [
+        i * (i + 1) // 2 for i in range(1, 9)
+    ]
+    assert all(g.db is maindb for g in getters)
+
+
+class ExampleCopyGetter(ExampleGetter):
+    columns = ["value", "half", "label"]
+    dtypes = {"value": "int64", "half": "float64"}
+    copy_fastpath = True
+
+    def query(self):
+        return """SELECT s AS value, s/2.::FLOAT AS half, 'label_'||s AS label
+                    FROM generate_series(1,%(value)s) AS s;"""
+
+
+def test_copy_getter(maindb):
+    df = ExampleCopyGetter(value=100, db=maindb).get_result()
+    assert len(df) == 100
+    assert df["value"].dtype == "int64"
+    assert df["half"].sum() == sum(range(1, 101)) / 2.0
+    df_slow = ExampleCopyGetter(value=100, db=maindb).get_result(copy_fastpath=False)
+    assert list(df_slow["label"]) == list(df["label"])
+
+
+class ExampleFailingCopyGetter(ExampleCopyGetter):
+    def query(self):
+        return "SELECT s/0 AS value, s AS half, 'label' AS label FROM generate_series(1,%(value)s) AS s;"
+
+
+def test_copy_getter_error(maindb):
+    # the error of the query is raised, not the one of restoring the DateStyle
+    with pytest.raises(dbf.database.psycopg2.errors.DivisionByZero):
+        ExampleFailingCopyGetter(value=10, db=maindb).get_result()
+    maindb.connection.rollback()
+    maindb.cursor.execute("SHOW DateStyle;")
+    assert not maindb.cursor.fetchone()[0].startswith("ISO")
+
+
+def test_prepared_getter(maindb):
+    for i in range(5):
+        df = ExampleGetter(value=i, db=maindb).get_result(prepared=True)
+        assert list(df["value"]) == [i]
+    statements = maindb.prepared_statements.get_statements(maindb.connection)
+    assert len(statements) == 1
+
+
+def test_prepared_cache_lru(maindb):
+    cache = dbf.database.PreparedStatementCache(maxsize=2)
+    for i in range(4):
+        cache.execute(maindb.cursor, f"SELECT %(value)s::INT + {i};", {"value": i})
+        assert maindb.cursor.fetchone()[0] == 2 * i
+    assert len(cache.get_statements(maindb.connection)) == 2
+    maindb.cursor.execute("SELECT COUNT(*) FROM pg_prepared_statements;")
+    assert maindb.cursor.fetchone()[0] == 2
+
+
+def test_prepared_cache_errors(maindb):
+    cache = dbf.database.PreparedStatementCache(maxsize=2)
+    maindb.cursor.execute("DEALLOCATE ALL;")
+    for i in range(3):
+        with pytest.raises(dbf.database.psycopg2.errors.DivisionByZero):
+            cache.execute(maindb.cursor, "SELECT 1/%(value)s::INT;", {"value": 0})
+        maindb.connection.rollback()
+    cache.execute(maindb.cursor, "SELECT 1/%(value)s::INT;", {"value": 1})
+    assert maindb.cursor.fetchone()[0] == 1
+    maindb.cursor.execute("SELECT COUNT(*) FROM pg_prepared_statements;")
+    assert maindb.cursor.fetchone()[0] == 1
+
+    maindb.cursor.execute("DEALLOCATE ALL;")
+    with pytest.raises(dbf.database.psycopg2.errors.InvalidSqlStatementName):
+        cache.execute(maindb.cursor, "SELECT 1/%(value)s::INT;", {"value": 1})
+    maindb.connection.rollback()
+    cache.execute(maindb.cursor, "SELECT 1/%(value)s::INT;", {"value": 1})
+    assert maindb.cursor.fetchone()[0] == 1
+
+
+@pytest.fixture
+def example_df():
+    import numpy as np
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            "id": np.arange(4, dtype=np.int32),
+            "flag": np.array([True, False, True, False]),
+            "value": [1.5, np.nan, 3.0, -2.0],
+            "nullable_int": pd.array([1, None, 3, 4], dtype="Int64"),
+            "created_at": pd.to_datetime(
+                ["2020-01-01 10:00", None, "2021-02-03 00:00", "2021-02-04 00:00"]
+            ),
+            "label": pd.Categorical(["a\tb", None, "c\\d", "a\tb"]),
+        }
+    )
+
+
+def test_dataframe_to_copy_text(example_df):
+    text = dbf.database.dataframe_to_copy_text(example_df)
+    lines = text.split("\n")
+    assert len(lines) == 5 and lines[-1] == ""
+    assert lines[0].split("\t") == [
+        "0",
+        "t",
+        "1.5",
+        "1",
+        "2020-01-01T10:00:00.000000",
+        "a\\tb",
+    ]
+    assert lines[1].split("\t")[2:] == ["\\N"] * 4
+
+
+def test_write_dataframe(maindb, example_df):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_write_df;
+        CREATE TABLE test_write_df(id INT PRIMARY KEY, flag BOOLEAN, value DOUBLE PRECISION,
+                                    nullable_int BIGINT, created_at TIMESTAMP, label TEXT);"""
+    )
+    maindb.write_dataframe(example_df, table="test_write_df")
+    maindb.cursor.execute(
+        "SELECT COUNT(*),COUNT(value),COUNT(label),SUM(nullable_int) FROM test_write_df;"
+    )
+    assert maindb.cursor.fetchone() == (4, 3, 3, 8)
+    maindb.cursor.execute("SELECT label FROM test_write_df WHERE id=0;")
+    assert maindb.cursor.fetchone()[0] == "a\tb"
+
+    with pytest.raises(Exception):
+        maindb.write_dataframe(example_df, table="test_write_df")
+    maindb.connection.rollback()
+
+    maindb.write_dataframe(example_df.iloc[:2], table="test_write_df", mode="replace")
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_write_df;")
+    assert maindb.cursor.fetchone()[0] == 2
+
+    updated_df = example_df.assign(value=10.0)
+    maindb.write_dataframe(
+        updated_df, table="test_write_df", mode="upsert", conflict_columns=["id"]
+    )
+    maindb.cursor.execute("SELECT COUNT(*),SUM(value) FROM test_write_df;")
+    assert maindb.cursor.fetchone() == (4, 40.0)
+
+
+def test_merge_snapshot(maindb, tmpdir):
+    import pandas as pd
+
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_snapshot;
+        CREATE TABLE test_snapshot(id INT PRIMARY KEY, name TEXT, value INT);
+        DELETE FROM _fillers_changes WHERE table_name='test_snapshot';"""
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    df = pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", None], "value": [1, 2, 3]})
+    assert f.merge_snapshot(df, table="test_snapshot", key_columns=["id"]) == dict(
+        inserted=3, updated=0, deleted=0
+    )
+    assert f.merge_snapshot(df, table="test_snapshot", key_columns=["id"]) == dict(
+        inserted=0, updated=0, deleted=0
+    )
+    df2 = pd.DataFrame({"id": [1, 3, 4], "name": ["a", "c", "d"], "value": [1, 3, 4]})
+    assert f.merge_snapshot(df2, table="test_snapshot", key_columns=["id"]) == dict(
+        inserted=1, updated=1, deleted=1
+    )
+    maindb.cursor.execute("SELECT id,name FROM test_snapshot ORDER BY id;")
+    assert maindb.cursor.fetchall() == [(1, "a"), (3, "c"), (4, "d")]
+    maindb.cursor.execute(
+        "SELECT SUM(inserted),SUM(updated),SUM(deleted) FROM _fillers_changes WHERE table_name='test_snapshot';"
+    )
+    assert maindb.cursor.fetchone() == (4, 1, 1)
+
+
+@pytest.fixture
+def local_remote(tmpdir):
+    import subprocess
+
+    def git(*args, cwd=None):
+        subprocess.check_call(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test"] + list(args),
+            cwd=cwd,
+        )
+
+    src = os.path.join(tmpdir, "src")
+    remote = os.path.join(tmpdir, "remotes", "example_repo.git")
+    git("init", "-q", "-b", "main", src)
+    for i in range(3):
+        with open(os.path.join(src, "file.txt"), "w") as f:
+            f.write(f"version {i}")
+        git("add", "file.txt", cwd=src)
+        git("commit", "-q", "-m", f"commit {i}", cwd=src)
+    git("clone", "-q", "--bare", src, remote)
+    return remote
+
+
+@pytest.fixture
+def git_daemon(local_remote):
+    """
+    Serves local_remote with git daemon on localhost, yields its git:// URL
+    """
+    import socket
+    import subprocess
+
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    base_path = os.path.dirname(local_remote)
+    daemon = subprocess.Popen(
+        [
+            "git",
+            "daemon",
+            "--export-all",
+            "--reuseaddr",
+            "--listen=127.0.0.1",
+            f"--port={port}",
+            f"--base-path={base_path}",
+            base_path,
+        ]
+    )
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield f"git://127.0.0.1:{port}/{os.path.basename(local_remote)}"
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_clone_local(local_remote, git_daemon, tmpdir):
+    f = fillers.Filler(data_folder=os.path.join(tmpdir, "data"))
+    f.clone_repo(repo_url=local_remote, branch="main", single_branch=True)
+    repo_folder = os.path.join(f.data_folder, "example_repo")
+    with open(os.path.join(repo_folder, "file.txt")) as fi:
+        assert fi.read() == "version 2"
+    f.clone_repo(repo_url=local_remote, update=True)
+    f.clone_repo(repo_url=local_remote, replace=True)
+    # shallow clone, through the git protocol (not supported by the local transport of libgit2)
+    f.clone_repo(repo_url=git_daemon, repo_folder="example_repo_shallow", depth=1)
+    shallow_folder = os.path.join(f.data_folder, "example_repo_shallow")
+    assert os.path.exists(os.path.join(shallow_folder, ".git", "shallow"))
+    with open(os.path.join(shallow_folder, "file.txt")) as fi:
+        assert fi.read() == "version 2"
+
+
+def test_clone_mirror(local_remote, tmpdir):
+    f = fillers.Filler(data_folder=os.path.join(tmpdir, "data"))
+    f.clone_repo(repo_url=local_remote, mirror_cache=True)
+    f.clone_repo(repo_url=local_remote, mirror_cache=True, update=True)
+    f.clone_repo(repo_url=local_remote, mirror_cache=True, replace=True)
+    mirrors = os.listdir(os.path.join(f.data_folder, "_mirrors"))
+    assert len(mirrors) == 1
+    repo_folder = os.path.join(f.data_folder, "example_repo")
+    assert os.path.exists(
+        os.path.join(repo_folder, ".git", "objects", "info", "alternates")
+    )
+    # existing working copy without update: the (now unreachable) remote is not fetched
+    os.rename(local_remote, local_remote + ".moved")
+    f.clone_repo(repo_url=local_remote, mirror_cache=True)
+    with pytest.raises(RuntimeError):
+        f.clone_repo(repo_url=local_remote, mirror_cache=True, update=True)
+
+
+def test_clone_repos(local_remote, tmpdir):
+    f = fillers.Filler(data_folder=os.path.join(tmpdir, "data"))
+    missing = os.path.join(tmpdir, "remotes", "missing_repo.git")
+    errors = f.clone_repos([local_remote, missing], workers=2)
+    assert errors[local_remote] is None
+    assert errors[missing] is not None
+    with pytest.raises(Exception):
+        f.clone_repos([missing], raise_errors=True)
+
+
+@pytest.fixture
+def csv_sources(tmpdir):
+    import gzip
+    import zipfile
+
+    content = "id,name\n" + "".join(f'{i},"name\n{i}"\n' for i in range(100))
+    content += "not_an_int,name\n"
+    content += "101,too,many\n"
+    with open(os.path.join(tmpdir, "example.csv"), "w") as f:
+        f.write(content)
+    with gzip.open(os.path.join(tmpdir, "example.csv.gz"), "wt") as f:
+        f.write(content)
+    with zipfile.ZipFile(os.path.join(tmpdir, "example.zip"), "w") as f:
+        f.writestr("example.csv", content)
+    return ["example.csv", "example.csv.gz", "example.zip"]
+
+
+def test_stream_rows(csv_sources, tmpdir):
+    f = fillers.Filler(data_folder=tmpdir)
+    for source in csv_sources:
+        rows = list(f.stream_rows(source))
+        assert len(rows) == 102
+        assert rows[1] == ["1", "name\n1"]
+
+
+def test_stream_csv(maindb, csv_sources, tmpdir):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_stream;
+        CREATE TABLE test_stream(id INT, name TEXT);"""
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    for source in csv_sources:
+        counts = f.stream_csv(
+            source,
+            table="test_stream",
+            columns=["id", "name"],
+            transforms=[lambda row: None if row[0] == "0" else row],
+            batch_size=7,
+        )
+        assert counts == dict(loaded=99, filtered=1, rejected=2)
+        with open(os.path.join(tmpdir, "test_stream_rejects.csv")) as fi:
+            assert len(list(csv.reader(fi))) == 2
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_stream;")
+    assert maindb.cursor.fetchone()[0] == 3 * 99
+
+
+@pytest.fixture
+def large_csv(tmpdir):
+    rows = [["id", "text"]] + [
+        [str(i), "multi\nline" if i % 3 else 'with "quotes"'] for i in range(1000)
+    ]
+    with open(os.path.join(tmpdir, "large.csv"), "w", newline="") as f:
+        csv.writer(f, lineterminator="\n").writerows(rows)
+    return "large.csv"
+
+
+def test_split_records(large_csv, tmpdir):
+    path = os.path.join(tmpdir, large_csv)
+    with open(path, "rb") as f:
+        content = f.read()
+    for block_size in (16, 2**20):
+        chunks = fillers.split_records(
+            path, n_chunks=4, header=True, block_size=block_size
+        )
+        assert len(chunks) == 4
+        rows = []
+        for start, end in chunks:
+            rows += list(csv.reader(io.StringIO(content[start:end].decode())))
+        assert [int(r[0]) for r in rows] == list(range(1000))
+
+
+@pytest.mark.parametrize("atomic", ["tpc", "staging"])
+def test_parallel_copy(maindb, large_csv, tmpdir, atomic):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_parallel_copy;
+        CREATE TABLE test_parallel_copy(id INT PRIMARY KEY, text TEXT);"""
+    )
+    maindb.connection.commit()
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    stats = f.parallel_copy(
+        large_csv, table="test_parallel_copy", workers=4, header=True, atomic=atomic
+    )
+    assert sum(s["rows"] for s in stats) == 1000
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_parallel_copy;")
+    assert maindb.cursor.fetchone()[0] == 1000
+
+    # duplicate keys make some chunks fail: nothing should be committed
+    maindb.cursor.execute("DELETE FROM test_parallel_copy WHERE id>=500;")
+    maindb.connection.commit()
+    with pytest.raises(Exception):
+        f.parallel_copy(
+            large_csv, table="test_parallel_copy", workers=4, header=True, atomic=atomic
+        )
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_parallel_copy;")
+    assert maindb.cursor.fetchone()[0] == 500
+    maindb.cursor.execute(
+        "SELECT COUNT(*) FROM pg_prepared_xacts WHERE database=current_database();"
+    )
+    assert maindb.cursor.fetchone()[0] == 0
+
+
+class FlakyCommitConnection(dbf.database.psycopg2.extensions.connection):
+    failures = 1
+
+    def tpc_commit(self, *args):
+        if not len(args) and FlakyCommitConnection.failures > 0:
+            FlakyCommitConnection.failures -= 1
+            raise dbf.database.psycopg2.OperationalError("simulated commit failure")
+        return super().tpc_commit(*args)
+
+
+def test_parallel_copy_commit_failure(maindb, large_csv, tmpdir, monkeypatch):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_parallel_copy;
+        CREATE TABLE test_parallel_copy(id INT PRIMARY KEY, text TEXT);"""
+    )
+    maindb.connection.commit()
+    monkeypatch.setattr(
+        maindb,
+        "new_connection",
+        lambda: dbf.database.psycopg2.connect(
+            connection_factory=FlakyCommitConnection, **maindb.db_conninfo
+        ),
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    f.parallel_copy(
+        large_csv, table="test_parallel_copy", workers=4, header=True, atomic="tpc"
+    )
+    assert FlakyCommitConnection.failures == 0
+    # the chunk failing to commit is committed again, nothing is left prepared
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_parallel_copy;")
+    assert maindb.cursor.fetchone()[0] == 1000
+    maindb.cursor.execute(
+        "SELECT COUNT(*) FROM pg_prepared_xacts WHERE database=current_database();"
+    )
+    assert maindb.cursor.fetchone()[0] == 0
+
+
+def test_write_controller():
+    controller = dbf.WriteController(
+        batch_size=100, target_latency=0.1, max_batch_size=1000, commit_every=2
+    )
+    controller.record(rows=100, seconds=0.01)
+    assert controller.batch_size == 150
+    controller.record(rows=150, seconds=1.0)
+    assert controller.batch_size == 75
+    assert controller.should_commit()
+    assert not controller.should_commit()
+    assert [len(b) for b in controller.batches(range(200))] == [75, 75, 50]
+
+    controller = dbf.WriteController(max_rows_per_sec=1000, target_latency=None)
+    t0 = time.time()
+    for _ in range(3):
+        controller.record(rows=100, seconds=0.0)
+    assert time.time() - t0 >= 0.25
+
+
+def test_controlled_writes(maindb, tmpdir, example_df):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_controlled;
+        CREATE TABLE test_controlled(id INT);"""
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    controller = dbf.WriteController(
+        batch_size=10, commit_every=3, cursor=maindb.cursor, max_replica_lag=60
+    )
+    f.execute_batch(
+        "INSERT INTO test_controlled(id) VALUES (%s);",
+        [(i,) for i in range(1000)],
+        controller=controller,
+        commit=True,
+    )
+    maindb.write_dataframe(
+        example_df[["id"]], table="test_controlled", controller=controller
+    )
+    maindb.cursor.execute("SELECT COUNT(*) FROM test_controlled;")
+    assert maindb.cursor.fetchone()[0] == 1004
+
+
+def test_controlled_stream_csv(maindb, csv_sources, tmpdir):
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_stream;
+        CREATE TABLE test_stream(id INT, name TEXT);"""
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    controller = dbf.WriteController(batch_size=10, target_latency=None)
+    f.stream_csv(
+        csv_sources[0],
+        table="test_stream",
+        columns=["id", "name"],
+        controller=controller,
+    )
+    # bytes of the COPY data are counted for max_bytes_per_sec, including rows retried one by one
+    assert controller.rows == 101
+    assert controller.bytes >= sum(len(f"{i}\tname\\n{i}\n") for i in range(100))
+
+
+class ExamplePartitionGetter(dbf.Getter):
+    columns = ["day", "value"]
+    partition_keys = {"region": "region"}
+
+    def __init__(self, region=None, **kwargs):
+        dbf.Getter.__init__(self, **kwargs)
+        self.region = region
+
+    def query(self):
+        return f"""SELECT to_char(day,'YYYY-MM-DD') AS day, value FROM test_partitioned_list
+                    WHERE {self.partition_filter()} ORDER BY day;"""
+
+    def query_attributes(self):
+        return {"region": self.region}
+
+    def parse_results(self, query_result):
+        return query_result
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_partitions(maindb, tmpdir, workers):
+    import pandas as pd
+
+    maindb.cursor.execute(
+        """DROP TABLE IF EXISTS test_partitioned_range;
+        DROP TABLE IF EXISTS test_partitioned_list;
+        DROP TABLE IF EXISTS test_partitioned_hash;"""
+    )
+    f = fillers.Filler(data_folder=tmpdir)
+    maindb.add_filler(f)
+    columns_definition = "day DATE NOT NULL, region TEXT NOT NULL, value INT"
+    f.declare_partitioned_table(
+        "test_partitioned_range",
+        columns_definition,
+        partition_by="range",
+        partition_key="day",
+        interval="month",
+    )
+    f.declare_partitioned_table(
+        "test_partitioned_list",
+        columns_definition,
+        partition_by="list",
+        partition_key="region",
+    )
+    f.declare_partitioned_table(
+        "test_partitioned_hash",
+        columns_definition,
+        partition_by="hash",
+        partition_key="region",
+        modulus=4,
+    )
+    df = pd.DataFrame(
+        {
+            "day": pd.date_range("2020-01-01", "2020-06-29", freq="D"),
+            "region": ["north", "south", "east"] * 60 + ["west"],
+        }
+    ).assign(value=1)
+
+    def count_partitions(table):
+        maindb.cursor.execute(
+            "SELECT COUNT(*) FROM pg_inherits WHERE inhparent=%s::regclass;", (table,)
+        )
+        return maindb.cursor.fetchone()[0]
+
+    loaded = f.load_partitions("test_partitioned_range", df, workers=workers)
+    assert len(loaded) == count_partitions("test_partitioned_range") == 6
+    f.load_partitions("test_partitioned_list", df, workers=workers, mode="swap")
+    f.load_partitions("test_partitioned_list", df, workers=workers, mode="swap")
+    assert count_partitions("test_partitioned_list") == 4
+    assert count_partitions("test_partitioned_hash") == 4
+    maindb.write_dataframe(df, table="test_partitioned_hash")
+
+    f.load_partitions(
+        "test_partitioned_range", df[df["day"] < "2020-02-01"].assign(value=2)
+    )
+    for table, total in [
+        ("test_partitioned_range", len(df) + 31),
+        ("test_partitioned_list", len(df)),
+        ("test_partitioned_hash", len(df)),
+    ]:
+        maindb.cursor.execute(f"SELECT SUM(value) FROM {table};")
+        assert maindb.cursor.fetchone()[0] == total
+
+    f.detach_partition("test_partitioned_list", "west", drop=True)
+    assert count_partitions("test_partitioned_list") == 3
+
+    assert len(ExamplePartitionGetter(region="north", db=maindb).get_result()) == 60
+    assert len(ExamplePartitionGetter(db=maindb).get_result()) == len(df) - 1
+    maindb.cursor.execute(
+        "EXPLAIN " + ExamplePartitionGetter(region="north").query(),
+        {"region": "north"},
+    )
+    plan = "\n".join(r[0] for r in maindb.cursor.fetchall())
+    assert "test_partitioned_list_north" in plan
+    assert "test_partitioned_list_south" not in plan
+
+
+def test_derived_tables(maindb, tmpdir):
+    maindb.cursor.execute(
+        """DROP MATERIALIZED VIEW IF EXISTS test_derived_mv CASCADE;
+        DROP TABLE IF EXISTS test_derived_table CASCADE;
+        DROP TABLE IF EXISTS test_derived_source CASCADE;
+        CREATE TABLE test_derived_source(region TEXT, value INT);
+        INSERT INTO test_derived_source SELECT 'r'||(s%3), s FROM generate_series(1,100) s;"""
+    )
+    maindb.connection.commit()
+    mv = fillers.DerivedTableFiller(
+        table="test_derived_mv",
+        query="SELECT region, SUM(value) AS total FROM test_derived_source GROUP BY region",
+        sources=["test_derived_source"],
+        unique_columns=["region"],
+    )
+    table = fillers.DerivedTableFiller(
+        table="test_derived_table",
+        query="SELECT SUM(total) AS total FROM test_derived_mv",
+        sources=["test_derived_mv"],
+        materialized_view=False,
+    )
+    group = fillers.DerivedTablesFiller(fillers=[table, mv], workers=2)
+    assert [[f.table for f in wave] for wave in group.get_waves()] == [
+        ["test_derived_mv"],
+        ["test_derived_table"],
+    ]
+    maindb.add_filler(group)
+    maindb.fill_db()
+    maindb.cursor.execute("SELECT total FROM test_derived_table;")
+    assert maindb.cursor.fetchone()[0] == 5050
+
+    assert not mv.refresh(connection=maindb.connection)
+    maindb.cursor.execute("INSERT INTO test_derived_source VALUES ('r0',1000);")
+    maindb.connection.commit()
+    assert mv.refresh(connection=maindb.connection)
+    assert not mv.refresh(connection=maindb.connection)
+    assert table.refresh(connection=maindb.connection)
+    maindb.cursor.execute("SELECT total FROM test_derived_table;")
+    assert maindb.cursor.fetchone()[0] == 6050
+
+    # changes keeping the number of rows, and truncations
+    maindb.cursor.execute(
+        """DELETE FROM test_derived_source WHERE value=1000;
+        INSERT INTO test_derived_source VALUES ('r1',1000);"""
+    )
+    maindb.connection.commit()
+    assert mv.refresh(connection=maindb.connection)
+    maindb.cursor.execute("TRUNCATE test_derived_source;")
+    maindb.connection.commit()
+    assert mv.refresh(connection=maindb.connection)
+    assert table.refresh(connection=maindb.connection)
+    assert not table.refresh(connection=maindb.connection)
+    # the log of changes is compacted by refreshes
+    maindb.cursor.execute(
+        "SELECT COUNT(*) FROM _derived_sources_changes WHERE source_oid='test_derived_source'::regclass;"
+    )
+    assert maindb.cursor.fetchone()[0] == 1
+
+
+class MemoryHungryFiller(fillers.Filler):
+    def __init__(self, size=50 * 2**20, **kwargs):
+        fillers.Filler.__init__(self, **kwargs)
+        self.size = size
+
+    def apply(self):
+        data = []
+        for _ in range(self.size // 2**20):
+            data.append(bytearray(2**20))
+            time.sleep(0.001)
+        self.db.connection.commit()
+
+
+def test_memory_tracker():
+    with dbf.memory.MemoryTracker(tracemalloc_top=5) as tracker:
+        data = [bytearray(2**20) for _ in range(50)]
+        time.sleep(0.2)
+    assert tracker.rss_peak_delta >= 40 * 2**20
+    assert len(tracker.top_allocations) == 5
+    del data
+
+    rss = dbf.memory.get_rss()
+    with pytest.raises(dbf.memory.MemoryLimitExceeded):
+        with dbf.memory.MemoryTracker(hard_limit=rss + 50 * 2**20, interval=0.01):
+            data = []
+            for _ in range(1000):
+                data.append(bytearray(2**20))
+                time.sleep(0.001)
+    del data
+
+    # not swallowed by except Exception
+    data = []
+    with pytest.raises(dbf.memory.MemoryLimitExceeded):
+        with dbf.memory.MemoryTracker(hard_limit=rss + 50 * 2**20, interval=0.01):
+            for _ in range(1000):
+                try:
+                    data.append(bytearray(2**20))
+                    time.sleep(0.001)
+                except Exception:
+                    pass
+    assert len(data) < 1000
+    del data
+
+    # raised once: the cleanup of the block is not interrupted, and swallowing it does not prevent the abort
+    cleaned = False
+    with pytest.raises(dbf.memory.MemoryLimitExceeded):
+        with dbf.memory.MemoryTracker(hard_limit=rss + 50 * 2**20, interval=0.01):
+            data = []
+            try:
+                for _ in range(1000):
+                    data.append(bytearray(2**20))
+                    time.sleep(0.001)
+            except BaseException:
+                pass
+            finally:
+                time.sleep(0.2)
+                cleaned = True
+    assert cleaned
+    del data
+
+
+def test_fill_memory(tmpdir):
+    db = Database(memory_tracking=True, tracemalloc_top=3, **conninfo)
+    db.init_db()
+    db.add_filler(MemoryHungryFiller(data_folder=tmpdir))
+    db.fill_db()
+    db.cursor.execute(
+        "SELECT step,rss_peak_delta FROM _fillers_memory WHERE class='MemoryHungryFiller' ORDER BY id DESC LIMIT 1;"
+    )
+    step, delta = db.cursor.fetchone()
+    assert step == "apply" and delta > 0
+
+    db.memory_hard_limit = dbf.memory.get_rss() + 50 * 2**20
+    db.add_filler(MemoryHungryFiller(size=2**30, data_folder=tmpdir))
+    with pytest.raises(dbf.memory.MemoryLimitExceeded):
+        db.fill_db()
+    db.cursor.execute(
+        "SELECT status FROM _fillers_info WHERE class='MemoryHungryFiller' ORDER BY id DESC LIMIT 1;"
+    )
+    assert db.cursor.fetchone()[0] == "memory_limit_exceeded_apply"
+    db.connection.close()
+
+
+class FanoutFiller(fillers.Filler):
+    prepare_calls = 0
+
+    def prepare(self):
+        fillers.Filler.prepare(self)
+        FanoutFiller.prepare_calls += 1
+        with open(os.path.join(self.data_folder, "fanout.csv"), "w") as f:
+            f.write("1,a\n2,b\n")
+
+    def apply(self):
+        self.db.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS fanout_test(id INT PRIMARY KEY, name TEXT);"
+        )
+        with open(os.path.join(self.data_folder, "fanout.csv"), "r") as f:
+            self.db.cursor.copy_expert("COPY fanout_test FROM STDIN CSV;", f)
+        self.db.connection.commit()
+
+
+def test_fill_dbs(maindb, tmpdir):
+    targets = [
+        Database(**dict(conninfo, database=f"test__db_fillers_target{i}"))
+        for i in range(3)
+    ]
+    for t in targets:
+        t.init_db()
+        t.cursor.execute("DROP TABLE IF EXISTS fanout_test;")
+        t.connection.commit()
+    targets[1].cursor.execute("CREATE TABLE fanout_test(id INT, name INT);")
+    targets[1].connection.commit()
+
+    maindb.add_filler(FanoutFiller(data_folder=tmpdir))
+    errors = maindb.fill_dbs(targets=targets)
+    assert FanoutFiller.prepare_calls == 1
+    assert errors[targets[0]] is None and errors[targets[2]] is None
+    assert errors[targets[1]] is not None
+
+    for i, t in enumerate(targets):
+        t.cursor.execute(
+            "SELECT status FROM _fillers_info WHERE class='FanoutFiller' ORDER BY id DESC LIMIT 1;"
+        )
+        status = t.cursor.fetchone()[0]
+        assert status == ("failed_apply" if i == 1 else "end_apply")
+        if i != 1:
+            t.cursor.execute("SELECT COUNT(*) FROM fanout_test;")
+            assert t.cursor.fetchone()[0] == 2
+        t.connection.close()
+
+
+def test_fill_dbs_memory(tmpdir):
+    db = Database(memory_tracking=True, tracemalloc_top=3, **conninfo)
+    db.init_db()
+    targets = [
+        Database(
+            memory_tracking=True,
+            tracemalloc_top=3,
+            **dict(conninfo, database=f"test__db_fillers_target{i}"),
+        )
+        for i in range(2)
+    ]
+    for t in targets:
+        t.init_db()
+    db.add_filler(MemoryHungryFiller(data_folder=tmpdir))
+    errors = db.fill_dbs(targets=targets)
+    assert all(e is None for e in errors.values())
+    for t in targets:
+        t.cursor.execute(
+            "SELECT status FROM _fillers_info WHERE class='MemoryHungryFiller' ORDER BY id DESC LIMIT 1;"
+        )
+        assert t.cursor.fetchone()[0] == "end_apply"
+        t.connection.close()
+    db.cursor.execute(
+        "SELECT rss_peak_delta,top_allocations FROM _fillers_memory WHERE class='MemoryHungryFiller' AND step='apply' ORDER BY id DESC LIMIT 1;"
+    )
+    delta, top_allocations = db.cursor.fetchone()
+    assert delta > 0 and len(top_allocations)
+    db.connection.close()
+
+
+class ExamplePlotGetter(dbf.Getter):
+    columns = ["series", "t", "value"]
+    plot_x = "t"
+    plot_y = "value"
+    plot_series = "series"
+
+    def __init__(self, n=10000, **kwargs):
+        dbf.Getter.__init__(self, **kwargs)
+        self.n = n
+
+    def query(self):
+        return """SELECT 'series_'||(s%%2) AS series, TIMESTAMP '2020-01-01' + s*INTERVAL '1 minute' AS t, sin(s/100.) AS value
+                    FROM generate_series(1,%(n)s) AS s;"""
+
+    def query_attributes(self):
+        return {"n": self.n}
+
+    def parse_results(self, query_result):
+        return query_result
+
+
+class ExampleFailingPlotGetter(ExamplePlotGetter):
+    def query(self):
+        return """SELECT 'series_'||(s%%2) AS series, TIMESTAMP '2020-01-01' + s*INTERVAL '1 minute' AS t, s/0 AS value
+                    FROM generate_series(1,%(n)s) AS s;"""
+
+
+@pytest.mark.parametrize("mode", ["bucket", "grid", "lttb"])
+def test_plot_data_error(maindb, mode):
+    # the error of the query is raised, not the one of restoring the DateStyle
+    with pytest.raises(dbf.database.psycopg2.errors.DivisionByZero):
+        ExampleFailingPlotGetter(db=maindb).get_plot_data(mode=mode, max_points=100)
+    maindb.connection.rollback()
+
+
+def test_lttb():
+    x = list(range(10000))
+    y = [0.0] * 10000
+    y[5000] = 10.0
+    indices = dbf.getters.lttb(x, y, 100)
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 9999
+    assert 5000 in indices
+    assert list(dbf.getters.lttb(x[:50], y[:50], 100)) == list(range(50))
+
+
+@pytest.mark.parametrize("mode", ["bucket", "grid", "lttb"])
+def test_plot_modes(maindb, mode, tmpdir):
+    getter = ExamplePlotGetter(db=maindb)
+    df = getter.get_plot_data(mode=mode, max_points=100)
+    assert set(df["series"]) == {"series_0", "series_1"}
+    # width_bucket puts the maximum in an extra bucket
+    assert df.groupby("series").size().max() <= (121 if mode == "grid" else 101)
+    ax = getter.plot_result(
+        mode=mode, max_points=100, show=False, outfile=os.path.join(tmpdir, "plot.png")
+    )
+    # repeated plots do not pile up on the same axes
+    ax2 = getter.plot_result(mode=mode, max_points=100, show=False)
+    assert ax2 is not ax
+    assert len(ax2.lines) == len(ax.lines) and len(ax2.collections) == len(
+        ax.collections
+    )
+    plt.close("all")
+
+
+def test_content_store(tmpdir):
+    store = dbf.ContentStore(folder=os.path.join(tmpdir, "store"))
+    for name in ("a.txt", "b.txt"):
+        with open(os.path.join(tmpdir, name), "w") as f:
+            f.write("same content")
+    assert store.add(os.path.join(tmpdir, "a.txt")) == store.add(
+        os.path.join(tmpdir, "b.txt")
+    )
+    assert os.path.samefile(
+        os.path.join(tmpdir, "a.txt"), os.path.join(tmpdir, "b.txt")
+    )
+    # blobs cannot be modified in place through their links
+    assert os.stat(os.path.join(tmpdir, "a.txt")).st_mode & 0o777 == 0o444
+    if os.geteuid() != 0:
+        with pytest.raises(PermissionError):
+            open(os.path.join(tmpdir, "a.txt"), "w")
+    digest = store.add(os.path.join(tmpdir, "b.txt"))
+    store.link(digest, os.path.join(tmpdir, "c.txt"))
+    store.link(digest, os.path.join(tmpdir, "a.txt"))
+    assert not [n for n in os.listdir(tmpdir) if n.startswith(".")]
+    assert store.gc() == (0, 0)
+    os.remove(os.path.join(tmpdir, "c.txt"))
+    os.remove(os.path.join(tmpdir, "a.txt"))
+    os.remove(os.path.join(tmpdir, "b.txt"))
+    assert store.gc() == (1, len("same content"))
+
+
+def test_content_store_unzip(tmpdir):
+    import zipfile
+
+    db = Database(content_store=True, **dict(conninfo, data_folder=str(tmpdir)))
+    db.init_db()
+    filler = fillers.Filler(data_folder=str(tmpdir))
+    db.add_filler(filler)
+    for name in ("a.zip", "b.zip"):
+        with zipfile.ZipFile(os.path.join(tmpdir, name), "w") as z:
+            z.writestr("folder/data.csv", "1,2\n" * 1000)
+    filler.record_file(filename="a.zip", filecode="a")
+    filler.unzip("a.zip", "extract_a")
+    filler.unzip("b.zip", "extract_b", clean_zip=True)
+    assert os.path.samefile(
+        os.path.join(tmpdir, "extract_a", "folder", "data.csv"),
+        os.path.join(tmpdir, "extract_b", "folder", "data.csv"),
+    )
+    assert os.path.samefile(
+        os.path.join(tmpdir, "a.zip"),
+        db.content_store.blob_path(
+            dbf.content_store.hash_file(os.path.join(tmpdir, "a.zip"))
+        ),
+    )
+    db.connection.close()
+
+
+def test_content_store_convert(tmpdir):
+    import pandas as pd
+
+    db = Database(content_store=True, **dict(conninfo, data_folder=str(tmpdir)))
+    db.init_db()
+    filler = fillers.Filler(data_folder=str(tmpdir))
+    db.add_filler(filler)
+    digests = {}
+    for version in range(2):
+        pd.DataFrame({"a": [version, 2], "b": ["x", "y"]}).to_excel(
+            os.path.join(tmpdir, "sheet.xlsx"), index=False, sheet_name="main"
+        )
+        # re-running conversions rewrites the recorded files without touching their blobs
+        filler.convert_spreadsheet("sheet.xlsx", destination="sheet.csv")
+        filler.convert_spreadsheet_sheets("sheet.xlsx", destination="sheets")
+        for name in ("sheet.csv", os.path.join("sheets", "main.csv")):
+            with open(os.path.join(tmpdir, name)) as f:
+                assert f.read().splitlines()[1].startswith(str(version))
+            filler.record_file(filename=name, filecode=name)
+            digests[name, version] = dbf.content_store.hash_file(
+                os.path.join(tmpdir, name)
+            )
+    for name, version in digests:
+        blob = db.content_store.blob_path(digests[name, version])
+        assert dbf.content_store.hash_file(blob) == digests[name, version]
+    db.connection.close()
+
+
+@pytest.fixture
+def sqlitedb(tmpdir):
+    db = Database(backend="sqlite", database=":memory:", data_folder=str(tmpdir))
+    db.init_db()
+    yield db
+    db.connection.close()
+
+
+class ExampleSQLiteFiller(fillers.Filler):
+    def apply(self):
+        self.db.cursor.execute(
+            "CREATE TABLE IF NOT EXISTS embedded_test(id INTEGER PRIMARY KEY, name TEXT, value REAL);"
+        )
+        self.db.cursor.execute(
+            "INSERT INTO embedded_test(id,name,value) VALUES (%(id)s,%(name)s,%(value)s);",
+            {"id": 1, "name": "it's", "value": 0.5},
+        )
+        self.db.connection.commit()
+
+
+class ExampleSQLiteGetter(dbf.Getter):
+    columns = ["id", "name", "value"]
+    dtypes = {"id": "int64", "value": "float64"}
+
+    def query(self):
+        return "SELECT id,name,value FROM embedded_test WHERE id >= %(min_id)s ORDER BY id;"
+
+    def query_attributes(self):
+        return {"min_id": 1}
+
+    def parse_results(self, query_result):
+        return query_result
+
+
+def test_sqlite_fill(sqlitedb, tmpdir):
+    sqlitedb.add_filler(ExampleSQLiteFiller(data_folder=str(tmpdir)))
+    sqlitedb.fill_db()
+    sqlitedb.cursor.execute(
+        "SELECT status FROM _fillers_info WHERE class='ExampleSQLiteFiller';"
+    )
+    assert [r[0] for r in sqlitedb.cursor.fetchall()][-1] == "end_apply"
+    df = ExampleSQLiteGetter(db=sqlitedb).get_result()
+    assert list(df["name"]) == ["it's"]
+    sqlitedb.clean_db()
+    assert sqlitedb.get_tables() == []
+
+
+def test_sqlite_stream_csv(sqlitedb, csv_sources, tmpdir):
+    sqlitedb.cursor.execute(
+        "CREATE TABLE embedded_stream(id INTEGER CHECK (typeof(id)='integer'), name TEXT);"
+    )
+    f = fillers.Filler(data_folder=str(tmpdir))
+    sqlitedb.add_filler(f)
+    counts = f.stream_csv(
+        csv_sources[0],
+        table="embedded_stream",
+        columns=["id", "name"],
+        transforms=[lambda row: None if row[0] == "0" else row],
+        batch_size=7,
+    )
+    assert counts == dict(loaded=99, filtered=1, rejected=2)
+    sqlitedb.cursor.execute("SELECT COUNT(*) FROM embedded_stream;")
+    assert sqlitedb.cursor.fetchone()[0] == 99
+    with pytest.raises(ValueError):
+        Database(
+            backend="sqlite",
+            database=":memory:",
+            db_schema="other",
+            data_folder=str(tmpdir),
+        )
+
+
+@pytest.mark.parametrize("copy_fastpath", [False, True])
+def test_sqlite_write_dataframe(sqlitedb, tmpdir, copy_fastpath):
+    import pandas as pd
+
+    sqlitedb.add_filler(ExampleSQLiteFiller(data_folder=str(tmpdir)))
+    sqlitedb.fill_db()
+    df = pd.DataFrame(
+        {"id": [2, 3, 4], "name": ["tab\there", None, "x"], "value": [1.5, None, 3]}
+    )
+    sqlitedb.write_dataframe(df, "embedded_test")
+    result = ExampleSQLiteGetter(db=sqlitedb).get_result(copy_fastpath=copy_fastpath)
+    assert list(result["id"]) == [1, 2, 3, 4]
+    assert result["name"][1] == "tab\there"
+    assert result["value"].isna().sum() == 1
+    results = sqlitedb.get_many(
+        [ExampleSQLiteGetter(name=f"getter_{i}") for i in range(4)], workers=2
+    )
+    assert all(len(r) == 4 for r in results.values())